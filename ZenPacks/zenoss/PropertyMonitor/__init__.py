@@ -28,6 +28,9 @@ CFG = zenpacklib.ZenPackSpec(
     zProperties={
         'DEFAULTS': {'category': 'Property Monitor'},
         'zPropertyMonitorInterval': {'type': 'int', 'default': 300},
+        'zPropertyMonitorPathCacheSize': {'type': 'int', 'default': 100000},
+        'zPropertyMonitorCacheBudget': {'type': 'int', 'default': 0},
+        'zPropertyMonitorFailureCacheSize': {'type': 'int', 'default': 100000},
     },
 
     classes={},
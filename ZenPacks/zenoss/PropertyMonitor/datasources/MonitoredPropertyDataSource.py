@@ -11,6 +11,8 @@
 Datasource type used for monitoring (numeric) model properties from ZODB
 '''
 
+import re
+
 from zope.component import adapts
 from zope.interface import implements
 
@@ -24,9 +26,18 @@ from Products.Zuul.interfaces import IRRDDataSourceInfo
 from Products.Zuul.utils import ZuulMessageFactory as _t
 from Products.ZenWidgets import messaging
 
-from Products.Zuul.interfaces import ICatalogTool, IInfo
+from Products.Zuul.interfaces import ICatalogTool
 from Products.AdvancedQuery import Eq
 
+from ZenPacks.zenoss.PropertyMonitor.utils import PropertyAccessors
+
+
+# Cycletimes that just name a zProperty, like the default.
+ZPROPERTY_CYCLETIME = re.compile(r'^\$\{(here|dev|device)/(z\w+)\}$')
+
+# Names that make a cycletime depend on more than the device.
+COMPONENT_NAMES = re.compile(r'\b(here|context|ds|datasource)\b')
+
 
 class MonitoredPropertyDataSource(ZenPackPersistence, SimpleRRDDataSource):
     '''
@@ -78,8 +89,34 @@ class MonitoredPropertyDataSource(ZenPackPersistence, SimpleRRDDataSource):
 
         return talesEvalStr(str(text), context, extra=extra)
 
-    def getCycleTime(self, context):
-        return int(self.talesEval(self.cycletime, context))
+    def getCycleTime(self, context, cache=None):
+        '''
+        Return the cycletime for context.
+
+        Plain numbers and single zProperty references are resolved
+        directly.  Other expressions go through talesEval, and when given
+        a cache dict, those that only refer to the device are evaluated
+        once per cache.
+        '''
+        text = str(self.cycletime).strip()
+        if text.isdigit():
+            return int(text)
+
+        match = ZPROPERTY_CYCLETIME.match(text)
+        if match:
+            variable, zProperty = match.groups()
+            if variable != 'here':
+                context = context.device()
+
+            return int(getattr(context, zProperty))
+
+        if cache is None or COMPONENT_NAMES.search(text):
+            return int(self.talesEval(text, context))
+
+        if text not in cache:
+            cache[text] = int(self.talesEval(text, context.device()))
+
+        return cache[text]
 
     def testDataSourceAgainstDevice(self, testDevice, REQUEST, write, errorLog):
         """
@@ -133,10 +170,11 @@ class MonitoredPropertyDataSource(ZenPackPersistence, SimpleRRDDataSource):
         if results.total > 10:
             out.write("%d %s components found, showing first 10<p>\n" % (results.total, class_name))
 
+        # Read the values the same way zenhub will when collecting them.
+        accessors = PropertyAccessors()
         for (i, result) in enumerate(results):
             obj = result.getObject()
-            info = IInfo(obj)
-            property_value = getattr(info, property_name, "ERROR")
+            property_value = accessors.getValue(obj, property_name, "ERROR")
 
             out.write("&nbsp;&nbsp;&nbsp; '%s' %s = %s<br>\n" % (obj.titleOrId(), property_name, property_value))
 
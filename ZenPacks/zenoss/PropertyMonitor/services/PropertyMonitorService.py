@@ -10,84 +10,1023 @@
 import logging
 log = logging.getLogger('zen.PropertyMonitor')
 
+from twisted.internet import defer, reactor, task
 from twisted.spread import pb
+import collections
+import copy
+import hashlib
+import itertools
 import time
 
 import Globals
 
+from Acquisition import aq_base, aq_inner, aq_parent
+from Products.AdvancedQuery import In
 from Products.ZenCollector.services.config import CollectorConfigService
+from Products.ZenHub.zodb import onUpdate, onDelete
+from Products.ZenModel.Device import Device
+from Products.ZenModel.DeviceClass import DeviceClass
+from Products.ZenModel.DeviceComponent import DeviceComponent
+from Products.ZenModel.RRDDataPoint import RRDDataPoint
+from Products.ZenModel.RRDDataSource import RRDDataSource
+from Products.ZenModel.RRDTemplate import RRDTemplate
+from Products.ZenModel.ThresholdClass import ThresholdClass
 from Products.ZenUtils.Utils import unused
-from Products.Zuul.interfaces import IInfo
+from Products.Zuul.interfaces import ICatalogTool
 
 from ZenPacks.zenoss.PropertyMonitor.datasources.MonitoredPropertyDataSource import MonitoredPropertyDataSource
+from ZenPacks.zenoss.PropertyMonitor.utils import (
+    Backoff,
+    LRUCache,
+    PropertyAccessors,
+    TemplateResolver,
+    )
 
 # Make pyflakes happy.
 unused(Globals)
 
 
 class PropertyMonitorService(CollectorConfigService):
+    # Cached device configs are rebuilt at least this often, for zenhub
+    # workers, which don't see invalidation events.
+    configCacheTTL = 60 * 60
+
+    # Properties that couldn't be read are reported in one log message at
+    # most this often.
+    failureLogInterval = 60
+
+    # Changed components are queued this many seconds before their values
+    # are read, pushBatchSize components per reactor iteration, and pushed
+    # to collectors in chunks of at most pushChunkSize values.
+    pushDelay = 5
+    pushBatchSize = 256
+    pushChunkSize = 1024
+
+    def __init__(self, dmd, instance):
+        CollectorConfigService.__init__(self, dmd, instance)
+
+        # registryKey -> (session, {spec id: (component path, property name)})
+        self._specTables = {}
+
+        # component path -> component, so that getObjByPath's traversal
+        # only happens once per component.  Entries are grouped by the oids
+        # of the component and its device, and evicted when zenhub sees
+        # either of them change or go away.  zenhub workers don't see those
+        # events, so hits are also checked against their parents.
+        self._pathCache = LRUCache(getattr(
+            dmd.Devices, 'zPropertyMonitorPathCacheSize', 100000))
+
+        # Components read since the ZODB connection's object cache was
+        # last minimized.  A budget of 0 leaves the cache to ZODB.
+        self._cacheBudget = getattr(
+            dmd.Devices, 'zPropertyMonitorCacheBudget', 0)
+        self._cacheUsed = 0
+
+        # (component path, property name) pairs that couldn't be read, and
+        # (component path, None) for paths that couldn't be resolved, are
+        # held off with exponential backoff.  Entries are grouped by the
+        # paths of the component and its device, and evicted when zenhub
+        # sees either of them change.
+        self._failures = Backoff(getattr(
+            dmd.Devices, 'zPropertyMonitorFailureCacheSize', 100000))
+        self._failureLog = {}
+        self._failureLogged = time.time()
+
+        # (meta_type, property_name) -> reader.  See describe() for what
+        # each property resolved to.
+        self.accessors = PropertyAccessors()
+
+        # device id -> (key, timestamp, proxy).  The key covers the device
+        # and its device classes' persistent serials, and a generation
+        # bumped whenever zenhub sees a template change.
+        self._configCache = {}
+        self._configCacheSwept = time.time()
+        self._templateGeneration = 0
+
+        # device id -> (config cache key, scan) of devices that passed
+        # _filterDevice, see remote_getDeviceConfigs.
+        self._scans = {}
+        self._templateResolver = None
+
+        # device id -> config cache key, computed once per device for the
+        # duration of remote_getDeviceConfigs, and None outside it.
+        self._cacheKeys = None
+
+        # (template generation, timestamp, class_names of all enabled
+        # Property datasources)
+        self._classNames = None
+
+        # Delta configs.  device id -> {version: {dsConfig key: digest}} for
+        # the versions built most recently, and device id -> the version
+        # the collector acknowledged applying in session _ackSession.
+        self._configVersions = {}
+        self._ackedConfigVersions = {}
+        self._ackSession = None
+        self._fullConfigs = False
+
+        # Pushed values.  device id -> {component path: set of monitored
+        # property names}, recorded when configs are built for collectors
+        # that asked for pushed values, and the changed components waiting
+        # to be read and pushed in the same form.
+        self._monitoredProperties = {}
+        self._pushPending = {}
+        self._pushCall = None
+
+    @onUpdate(Device)
+    def cachedDeviceUpdated(self, object, event):
+        self._pathCache.evictGroup(object._p_oid)
+        self._failures.evictGroup(object.getPrimaryId())
+        self._invalidateDevice(object.id)
+        self._queuePush(object)
+
+    @onDelete(Device)
+    def cachedDeviceDeleted(self, object, event):
+        self._pathCache.evictGroup(object._p_oid)
+        self._invalidateDevice(object.id)
+        self._configVersions.pop(object.id, None)
+        self._ackedConfigVersions.pop(object.id, None)
+        self._monitoredProperties.pop(object.id, None)
+
+    @onUpdate(DeviceComponent)
+    def cachedComponentUpdated(self, object, event):
+        self._pathCache.evictGroup(object._p_oid)
+        self._failures.evictGroup(object.getPrimaryId())
+        self._invalidateComponentDevice(object)
+        self._queuePush(object)
+
+    @onDelete(DeviceComponent)
+    def cachedComponentDeleted(self, object, event):
+        self._pathCache.evictGroup(object._p_oid)
+        self._invalidateComponentDevice(object)
+
+    @onUpdate(RRDTemplate)
+    def cachedTemplateUpdated(self, object, event):
+        self._templateGeneration += 1
+
+    @onUpdate(RRDDataSource)
+    def cachedDataSourceUpdated(self, object, event):
+        self._templateGeneration += 1
+
+    @onUpdate(RRDDataPoint)
+    def cachedDataPointUpdated(self, object, event):
+        self._templateGeneration += 1
+
+    @onUpdate(ThresholdClass)
+    def cachedThresholdUpdated(self, object, event):
+        self._templateGeneration += 1
+
+    def _invalidateComponentDevice(self, component):
+        try:
+            device = component.device()
+        except Exception:
+            # Deleted components may no longer know their device.
+            device = None
+
+        if device is not None:
+            self._invalidateDevice(device.id)
+        else:
+            self._configCache.clear()
+            self._scans.clear()
+
+    def _invalidateDevice(self, deviceId):
+        self._configCache.pop(deviceId, None)
+        self._scans.pop(deviceId, None)
+
+    def remote_getDeviceConfigs(self, *args, **kwargs):
+        # Template scans made while filtering devices are reused when
+        # building their configs, and component template bindings are
+        # shared between devices, for the duration of this request.
+        self._scans = {}
+        self._templateResolver = TemplateResolver()
+        self._classNames = None
+        self._cacheKeys = {}
+        try:
+            return CollectorConfigService.remote_getDeviceConfigs(
+                self, *args, **kwargs)
+        finally:
+            log.debug("Template bindings: %d resolved, %d reused; "
+                      "%d Property datasources skipped for other classes",
+                      self._templateResolver.misses,
+                      self._templateResolver.hits,
+                      self._templateResolver.skipped)
+            self._scans = {}
+            self._templateResolver = None
+            self._cacheKeys = None
+
     def _filterDevice(self, device):
-        include = CollectorConfigService._filterDevice(self, device)
-        # Check datasources on the device level
-        has_property_ds = any(template.getRRDDataSources("Property") for template in device.getRRDTemplates())
-        # Check datasources on the components level
-        if not has_property_ds:
-            has_property_ds = any(template.getRRDDataSources("Property")
-                                  for component in device.getMonitoredComponents()
-                                  for template in component.getRRDTemplates())
+        if not CollectorConfigService._filterDevice(self, device):
+            return False
+
+        if self._cachedProxy(device) is not None:
+            return True
+
+        scan = self._scanDevice(device)
+        if not scan:
+            return False
+
+        # Keep the scan for _createDeviceProxy, which normally follows
+        # within remote_getDeviceConfigs.  Other callers, such as
+        # getDeviceNames, don't build configs, so their scans are dropped.
+        if self._templateResolver is not None:
+            self._scans[device.id] = (self._configCacheKey(device), scan)
+
+        return True
 
-        return include and has_property_ds
+    def remote_getFullDeviceConfigs(self, deviceNames):
+        """
+        As remote_getDeviceConfigs, but never send a delta config.
+        """
+        self._fullConfigs = True
+        try:
+            return self.remote_getDeviceConfigs(deviceNames)
+        finally:
+            self._fullConfigs = False
+
+    def remote_resetConfigVersions(self, session):
+        """
+        Forget every acknowledged config version.  Collectors call this
+        when they start, before they have applied any configs.
+        """
+        self._ackSession = session
+        self._ackedConfigVersions = {}
+
+    def remote_ackConfigVersions(self, session, versions):
+        """
+        Record {device id: dsConfigVersion} the collector has applied, so
+        that later configs for those devices can be sent as deltas.  A
+        version of None forgets the device's acknowledged version.
+        """
+        if session != self._ackSession:
+            self.remote_resetConfigVersions(session)
+
+        for deviceId, version in versions.iteritems():
+            if version is None:
+                self._ackedConfigVersions.pop(deviceId, None)
+            else:
+                self._ackedConfigVersions[deviceId] = version
 
     def _createDeviceProxy(self, device):
+        proxy = self._cachedProxy(device)
+        if proxy is not None:
+            log.debug("%s: using cached config", device.id)
+            self._scans.pop(device.id, None)
+            if self._pushListeners():
+                self._recordMonitoredProperties(device, proxy)
+
+            return self._packProxy(self._deltaProxy(device, proxy))
+
+        key = self._configCacheKey(device)
+        scan = self._scans.pop(device.id, None)
+        if scan is None or scan[0] != key:
+            scan = self._scanDevice(device)
+        else:
+            scan = scan[1]
+
+        proxy = self._buildDeviceProxy(device, scan)
+
+        now = time.time()
+        if now - self._configCacheSwept > self.configCacheTTL:
+            for deviceId, cached in self._configCache.items():
+                if now - cached[1] >= self.configCacheTTL:
+                    del self._configCache[deviceId]
+            self._configCacheSwept = now
+
+        self._configCache[device.id] = (key, now, proxy)
+        if self._pushListeners():
+            self._recordMonitoredProperties(device, proxy)
+
+        return self._packProxy(
+            self._deltaProxy(device, self._copyProxy(proxy)))
+
+    def _cachedProxy(self, device):
+        """
+        Return a copy of device's cached config, or None if there isn't a
+        valid one.
+        """
+        cached = self._configCache.get(device.id)
+        if cached and cached[0] == self._configCacheKey(device) and \
+           time.time() - cached[1] < self.configCacheTTL:
+            return self._copyProxy(cached[2])
+
+    def _pushListeners(self):
+        """
+        Return the listening collectors that asked for pushed values.
+        """
+        return [
+            listener for listener in self.listeners
+            if (self.listenerOptions.get(listener) or {}).get('pushvalues')]
+
+    def _recordMonitoredProperties(self, device, proxy):
+        monitored = {}
+        for dsConfig in proxy.dsConfigs:
+            monitored.setdefault(dsConfig.component_path, set()) \
+                     .add(dsConfig.property_name)
+
+        self._monitoredProperties[device.id] = monitored
+
+    def _queuePush(self, deviceOrComponent):
+        """
+        Queue the monitored properties of a device or component zenhub saw
+        change to be read and pushed to collectors after pushDelay seconds.
+        Nothing is read here, in the invalidation handler.
+
+        zenhub may report a component change as an update of its device,
+        so a device update queues all of its components too.
+        """
+        if not self._monitoredProperties or not self._pushListeners():
+            return
+
+        try:
+            component_path = deviceOrComponent.getPrimaryId()
+            monitored = self._monitoredProperties.get(
+                deviceOrComponent.device().id, {})
+        except Exception:
+            return
+
+        if isinstance(deviceOrComponent, Device):
+            self._pushPending.update(monitored)
+        elif component_path in monitored:
+            self._pushPending[component_path] = monitored[component_path]
+        else:
+            return
+
+        if self._pushCall is None or not self._pushCall.active():
+            self._pushCall = reactor.callLater(self.pushDelay, self._pushPendingValues)
+
+    def _pushPendingValues(self):
+        """
+        Read and push the values of up to pushBatchSize queued paths, and
+        leave the rest to later reactor iterations.
+        """
+        values = []
+        for i in xrange(min(self.pushBatchSize, len(self._pushPending))):
+            component_path, properties = self._pushPending.popitem()
+            try:
+                obj = self._getObjByPath(component_path)
+            except Exception, e:
+                log.debug("Unable to push values of %s (%r)", component_path, e)
+                continue
+
+            for property_name in properties:
+                try:
+                    value = self.accessors.getValue(obj, property_name)
+                except Exception, e:
+                    log.debug("Unable to push %s -> %s (%r)",
+                              component_path, property_name, e)
+                    continue
+
+                values.extend((component_path, property_name, value, time.time()))
+
+        if values:
+            self._pushValues(values)
+
+        if self._pushPending:
+            self._pushCall = reactor.callLater(0, self._pushPendingValues)
+
+    def _pushValues(self, values):
+        """
+        Push values, a flat list of (component path, property name, value,
+        timestamp) quadruples, to collectors.
+        """
+        chunkSize = self.pushChunkSize * 4
+        for listener in self._pushListeners():
+            log.debug("Pushing %d values to %s", len(values) / 4, listener)
+            for i in xrange(0, len(values), chunkSize):
+                d = listener.callRemote(
+                    'pushPropertyValues', values[i:i + chunkSize])
+                d.addErrback(self._pushFailed)
+
+    def _pushFailed(self, result):
+        # The collector fetches the values itself when they get stale.
+        log.warning("Unable to push values to collector: %s",
+                    result.getErrorMessage())
+
+    def _recordConfigVersion(self, device, proxy):
+        """
+        Set proxy.dsConfigVersion, and remember the digests of its
+        dsConfigs so that later versions can be sent as deltas against it.
+        """
+        digests = {}
+        for dsConfig in proxy.dsConfigs:
+            key = dsConfig.key()
+            if key in digests:
+                # Ambiguous, so this device's configs are always sent whole.
+                proxy.dsConfigVersion = None
+                return
+
+            digests[key] = dsConfig.digest()
+
+        proxy.dsConfigVersion = hashlib.md5(
+            repr(sorted(digests.iteritems()))).hexdigest()
+
+        # Keep the acknowledged version and this one.
+        versions = self._configVersions.setdefault(
+            device.id, collections.OrderedDict())
+        acked = self._ackedConfigVersions.get(device.id)
+        for version in versions.keys():
+            if version != acked:
+                del versions[version]
+
+        versions[proxy.dsConfigVersion] = digests
+
+    def _deltaProxy(self, device, proxy):
+        """
+        Reduce proxy to the dsConfigs added or changed since the version
+        the collector acknowledged, if any.  dsConfigBase is then that
+        version and dsConfigsRemoved lists the keys of removed dsConfigs.
+        """
+        proxy.dsConfigBase = None
+        proxy.dsConfigsRemoved = []
+
+        base = self._ackedConfigVersions.get(device.id)
+        versions = self._configVersions.get(device.id, {})
+        if self._fullConfigs or proxy.dsConfigVersion is None or \
+           base not in versions or proxy.dsConfigVersion not in versions:
+            return proxy
+
+        previous = versions[base]
+        current = versions[proxy.dsConfigVersion]
+        proxy.dsConfigs = [
+            dsConfig for dsConfig in proxy.dsConfigs
+            if previous.get(dsConfig.key()) != current[dsConfig.key()]]
+        proxy.dsConfigsRemoved = [key for key in previous if key not in current]
+        proxy.dsConfigBase = base
+
+        log.debug("%s: sending %d changed and %d removed datasources",
+                  device.id, len(proxy.dsConfigs), len(proxy.dsConfigsRemoved))
+
+        return proxy
+
+    def _packProxy(self, proxy):
+        """
+        Replace proxy.dsConfigs with their packed form.  See
+        packDataSourceConfigs.
+        """
+        proxy.dsConfigSymbols, proxy.packedDsConfigs = \
+            packDataSourceConfigs(proxy.dsConfigs)
+        proxy.dsConfigs = []
+        return proxy
+
+    def _configCacheKey(self, device):
+        """
+        Return the key device's cached config is valid for.  Within
+        remote_getDeviceConfigs each device's key is only computed once,
+        since nothing can change it until the request returns.
+        """
+        if self._cacheKeys is None:
+            return self._computeConfigCacheKey(device)
+
+        key = self._cacheKeys.get(device.id)
+        if key is None:
+            key = self._cacheKeys[device.id] = self._computeConfigCacheKey(device)
+
+        return key
+
+    def _computeConfigCacheKey(self, device):
+        serials = [device._p_serial]
+        organizer = device.deviceClass()
+        while isinstance(organizer, DeviceClass):
+            serials.append(organizer._p_serial)
+            organizer = organizer.getPrimaryParent()
+
+        # Adding or removing components doesn't change the device's
+        # serial, and zenhub workers don't see the events for it either.
+        paths = sorted(brain.getPath() for brain in self._componentBrains(
+            device, self._propertyClassNames()))
+        components = hashlib.md5('\n'.join(paths)).hexdigest()
+
+        return (self._templateGeneration, tuple(serials), components)
+
+    def _copyProxy(self, proxy):
+        # Callers may modify what we return, so never hand out the cached
+        # proxy or its lists.
+        proxy = copy.copy(proxy)
+        proxy.dsConfigs = list(proxy.dsConfigs)
+        proxy.thresholds = list(proxy.thresholds)
+        return proxy
+
+    def _scanDevice(self, device):
+        """
+        Walk the templates of device and its monitored components once.
+        Only components of a class that some Property datasource is
+        configured for are considered.
+
+        Returns a list of (deviceOrComponent, [(template, datasource)])
+        for every object with an enabled Property datasource for its
+        class.  Datasources for other classes are skipped before anything
+        is built for them.
+        """
+        resolver = self._templateResolver or TemplateResolver()
+
+        scan = []
+        skipped = 0
+        components = self._monitoredComponents(
+            device, self._propertyClassNames())
+        for deviceOrComponent in itertools.chain((device,), components):
+            if deviceOrComponent is device:
+                templates = device.getRRDTemplates()
+            else:
+                templates = resolver.getRRDTemplates(deviceOrComponent, device)
+
+            sources = []
+            for template in templates:
+                index = resolver.getDataSourcesByClass(
+                    template, MonitoredPropertyDataSource.sourcetype)
+                for class_name, datasources in index.iteritems():
+                    if class_name == deviceOrComponent.meta_type:
+                        sources.extend((template, ds) for ds in datasources)
+                    else:
+                        skipped += len(datasources)
+
+            if sources:
+                scan.append((deviceOrComponent, sources))
+
+        resolver.skipped += skipped
+        log.debug("%s: skipped %d Property datasources for other classes",
+                  device.id, skipped)
+
+        return scan
+
+    def _propertyClassNames(self):
+        """
+        Return the set of class_names used by enabled Property datasources
+        in any template.
+        """
+        now = time.time()
+        if self._classNames and \
+           self._classNames[0] == self._templateGeneration and \
+           now - self._classNames[1] < self.configCacheTTL:
+            return self._classNames[2]
+
+        classNames = set()
+        for result in ICatalogTool(self.dmd.Devices).search(RRDTemplate):
+            try:
+                template = result.getObject()
+            except Exception, e:
+                log.warn("Unable to load template %s (%r)", result.getPath(), e)
+                continue
+
+            for datasource in template.getRRDDataSources(
+                    MonitoredPropertyDataSource.sourcetype):
+                if datasource.enabled and datasource.class_name:
+                    classNames.add(datasource.class_name)
+
+        log.debug("Property datasources are configured for %s",
+                  ', '.join(sorted(classNames)))
+
+        self._classNames = (self._templateGeneration, now, classNames)
+        return classNames
+
+    def _componentBrains(self, device, classNames):
+        """
+        Return the catalog results for device's components whose
+        meta_type is one of classNames.
+        """
+        if not classNames:
+            return []
+
+        results = ICatalogTool(device).search(
+            query=In('meta_type', list(classNames)),
+            filterPermissions=False)
+
+        devicePath = device.getPrimaryId()
+        return [result for result in results if result.getPath() != devicePath]
+
+    def _monitoredComponents(self, device, classNames):
+        """
+        Return device's monitored components whose meta_type is one of
+        classNames.  Only components found in the catalog are loaded.
+        """
+        for result in self._componentBrains(device, classNames):
+            try:
+                component = result.getObject()
+            except Exception, e:
+                log.warn("Unable to load component %s (%r)", result.getPath(), e)
+                continue
+
+            if component.monitored():
+                yield component
+
+    def _buildDeviceProxy(self, device, scan):
         proxy = CollectorConfigService._createDeviceProxy(self, device)
 
         proxy.configCycleInterval = 5 * 60
-        proxy.dsConfigs = list(self._dsConfigs(device))
-        proxy.thresholds = device.getThresholdInstances(
-            MonitoredPropertyDataSource.sourcetype)
-
-        proxy.thresholds += device.getThresholdInstances(
-            MonitoredPropertyDataSource.sourcetype)
+        proxy.dsConfigs = []
+        proxy.thresholds = []
 
-        # We only worry about monitoring templates against components right now.
-        for component in device.getMonitoredComponents():
-            proxy.dsConfigs.extend(self._dsConfigs(component))
-            proxy.thresholds.extend(component.getThresholdInstances(
+        # Device-level cycletime expressions are evaluated once per device.
+        cycletimes = {}
+        for deviceOrComponent, sources in scan:
+            proxy.dsConfigs.extend(
+                self._dsConfigs(deviceOrComponent, sources, cycletimes))
+            proxy.thresholds.extend(deviceOrComponent.getThresholdInstances(
                 MonitoredPropertyDataSource.sourcetype))
 
+        self._recordConfigVersion(device, proxy)
+
         return proxy
 
-    def _dsConfigs(self, deviceOrComponent):
-        for template in deviceOrComponent.getRRDTemplates():
-            for datasource in template.getRRDDataSources("Property"):
-                if not datasource.enabled:
-                    continue
+    def _dsConfigs(self, deviceOrComponent, sources, cycletimes=None):
+        for template, datasource in sources:
+            try:
+                dsConfig = PropertyMonitorDataSourceConfig(
+                    deviceOrComponent, template, datasource, cycletimes)
+            except Exception, e:
+                log.exception(e)
+                continue
 
-                try:
-                    dsConfig = PropertyMonitorDataSourceConfig(
-                        deviceOrComponent, template, datasource)
+            yield dsConfig
 
-                    # Filter out anything that is not applicable to
-                    # this component type for some reason.
-                    if dsConfig.class_name == deviceOrComponent.meta_type:
-                        yield dsConfig
+    def remote_register_specs(self, registryKey, session, specs, removedIds=()):
+        """
+        Register part of a collector's spec table.
 
-                except Exception, e:
-                    log.exception(e)
+        specs is a flat list of (spec id, component path, property name)
+        triples.  The table is discarded whenever the collector starts a
+        new session.
+        """
+        table = self._getSpecTable(registryKey, session)
+        for specId in removedIds:
+            table.pop(specId, None)
+
+        for i in xrange(0, len(specs), 3):
+            table[specs[i]] = (specs[i + 1], specs[i + 2])
+
+        log.debug("%s: %d specs registered, %d removed, %d total",
+                  registryKey, len(specs) / 3, len(removedIds), len(table))
+
+    def remote_fetch_spec_values(self, registryKey, session, specIds, specs=()):
+        """
+        Return the current values of previously registered specs.
+
+        Returns a flat list of (spec id, value, timestamp) triples, the
+        list of spec ids that have not been registered with this service,
+        and a flat list of (spec id, seconds) pairs for specs whose value
+        couldn't be read and won't be tried again for that many seconds.
+        Definitions may be passed inline in specs, as for
+        remote_register_specs.
+        """
+        if specs:
+            self.remote_register_specs(registryKey, session, specs)
+
+        table = self._getSpecTable(registryKey, session)
+        knownIds = []
+        unknownIds = []
+        for specId in specIds:
+            if specId in table:
+                knownIds.append(specId)
+            else:
+                unknownIds.append(specId)
+
+        values, failures = self._readSpecValues(table, knownIds)
+
+        log.debug("%s: path cache %r", registryKey, self._pathCache.stats())
+
+        return values, unknownIds, failures
+
+    @defer.inlineCallbacks
+    def remote_stream_spec_values(self, registryKey, session, specIds,
+                                  receiver, specs=(), batchSize=32):
+        """
+        As remote_fetch_spec_values, but send the values of each batch of
+        batchSize specs as soon as it has been read, with
+        receiver.callRemote('values', values, failures), instead of
+        returning them all at the end.  At most two batches are
+        outstanding at once.
+
+        Returns the list of spec ids that have not been registered with
+        this service.
+        """
+        if specs:
+            self.remote_register_specs(registryKey, session, specs)
+
+        table = self._getSpecTable(registryKey, session)
+        knownIds = []
+        unknownIds = []
+        for specId in specIds:
+            if specId in table:
+                knownIds.append(specId)
+            else:
+                unknownIds.append(specId)
+
+        outstanding = []
+        for i in xrange(0, len(knownIds), batchSize):
+            values, failures = self._readSpecValues(
+                table, knownIds[i:i + batchSize])
+            outstanding.append(receiver.callRemote('values', values, failures))
+            if len(outstanding) > 1:
+                yield outstanding.pop(0)
+            else:
+                # Let the reactor send the batch before reading the next.
+                yield task.deferLater(reactor, 0, lambda: None)
+
+        yield defer.gatherResults(outstanding)
+
+        defer.returnValue(unknownIds)
+
+    def _readSpecValues(self, table, specIds):
+        """
+        Read the values of registered specs.  Returns the values and
+        failures as for remote_fetch_spec_values.
+        """
+        values = []
+        failures = []
+        results, retries = self._fetchValues(
+            [table[specId] for specId in specIds])
+        for index, (specId, (value, timestamp)) in enumerate(zip(specIds, results)):
+            if index in retries:
+                failures.extend((specId, retries[index]))
+            else:
+                values.extend((specId, value, timestamp))
+
+        return values, failures
+
+    def remote_fetch_changed_spec_values(self, registryKey, session, specIds,
+                                         serials, specs=()):
+        """
+        As remote_fetch_spec_values, but only read the values of specs
+        whose component has changed.
+
+        serials holds the persistent serial (_p_serial) each spec's
+        component had when its value was last fetched, or None.  Returns a
+        flat list of (spec id, value, timestamp, serial) quadruples, the
+        unknown spec ids and failures as for remote_fetch_spec_values, and
+        the list of spec ids whose component hasn't changed since.
+
+        The serial only changes when the component itself is modified, so
+        properties computed from other objects are not picked up until the
+        component changes too.
+        """
+        if specs:
+            self.remote_register_specs(registryKey, session, specs)
+
+        table = self._getSpecTable(registryKey, session)
+        knownIds = []
+        knownSerials = []
+        unknownIds = []
+        for specId, serial in itertools.izip(specIds, serials):
+            if specId in table:
+                knownIds.append(specId)
+                knownSerials.append(serial)
+            else:
+                unknownIds.append(specId)
+
+        values = []
+        failures = []
+        unchanged = []
+        results, retries = self._fetchValues(
+            [table[specId] for specId in knownIds], knownSerials)
+        for index, (specId, result) in enumerate(zip(knownIds, results)):
+            if index in retries:
+                failures.extend((specId, retries[index]))
+            elif result is None:
+                unchanged.append(specId)
+            else:
+                values.extend((specId,) + result)
+
+        log.debug("%s: %d of %d specs unchanged", registryKey,
+                  len(unchanged), len(knownIds))
+
+        return values, unknownIds, failures, unchanged
 
     def remote_fetch_values(self, valueSpecs):
-        for spec in valueSpecs:
-            try:
-                obj = self.dmd.getObjByPath(spec.component_path)
-                spec.value = getattr(IInfo(obj), spec.property_name, None)
-                spec.timestamp = time.time()
-                log.debug("%s -> %s = %s", spec.component_path, spec.property_name, spec.value)
-            except Exception, e:
-                spec.value = None
-                log.error("Unable to retrieve %s -> %s (%r)", spec.component_path, spec.property_name, e)
+        results, retries = self._fetchValues(
+            [(spec.component_path, spec.property_name) for spec in valueSpecs])
+        for spec, (value, timestamp) in zip(valueSpecs, results):
+            spec.value = value
+            spec.timestamp = timestamp
 
         return valueSpecs
 
+    def _getSpecTable(self, registryKey, session):
+        if registryKey not in self._specTables or \
+           self._specTables[registryKey][0] != session:
+            self._specTables[registryKey] = (session, {})
+
+        return self._specTables[registryKey][1]
+
+    def _getObjByPath(self, component_path):
+        obj = self._pathCache.get(component_path)
+        if obj is not None and not self._isCurrent(obj):
+            # Deleted, and possibly recreated at the same path.
+            self._pathCache.pop(component_path)
+            obj = None
+
+        if obj is None:
+            obj = self.dmd.getObjByPath(component_path)
+            device = obj.device() if hasattr(obj, 'device') else None
+            groups = (obj._p_oid,)
+            if device is not None and device._p_oid != obj._p_oid:
+                groups += (device._p_oid,)
+            self._pathCache.put(component_path, obj, groups)
+
+        return obj
+
+    def _isCurrent(self, obj):
+        """
+        Return whether obj, and its device, are still the objects their
+        parents hold under their ids.
+        """
+        device = obj.device() if hasattr(obj, 'device') else None
+        for o in (obj, device):
+            if o is None:
+                continue
+
+            try:
+                current = aq_parent(aq_inner(o))._getOb(o.id)
+            except Exception:
+                return False
+
+            if aq_base(current) is not aq_base(o):
+                return False
+
+        return True
+
+    def _fetchValues(self, requests, serials=None):
+        """
+        Read the values for a list of (component path, property name)
+        pairs.
+
+        Each distinct component is resolved once, and each distinct property
+        read once, no matter how many datapoints ask for it.
+
+        Returns a list of (value, timestamp) pairs in the same order as
+        requests, and {index: seconds} for the requests that failed, or
+        were skipped because they failed recently, and won't be tried
+        again for that many seconds.  Their value and timestamp are None.
+
+        If serials, a list of component serials in the same order as
+        requests, is given, the requests whose component still has that
+        serial aren't read and their result is None.  The others' results
+        are (value, timestamp, serial).
+        """
+        indexes = {}
+        for index, (component_path, property_name) in enumerate(requests):
+            indexes.setdefault(component_path, {}) \
+                   .setdefault(property_name, []).append(index)
+
+        self._prefetch(indexes)
+
+        now = time.time()
+        results = [(None, None)] * len(requests)
+        retries = {}
+        for component_path, properties in indexes.iteritems():
+            retryAfter = self._failures.retryAfter((component_path, None), now)
+            if not retryAfter:
+                try:
+                    obj = self._getObjByPath(component_path)
+                except Exception, e:
+                    retryAfter = self._failed(component_path, None, e, now)
+                else:
+                    self._failures.succeeded((component_path, None))
+
+            if retryAfter:
+                for propertyIndexes in properties.itervalues():
+                    for index in propertyIndexes:
+                        retries[index] = retryAfter
+                continue
+
+            serial = None
+            if serials is not None:
+                # Ghosts don't know their serial until they are loaded.
+                base = aq_base(obj)
+                base._p_activate()
+                serial = base._p_serial
+
+            for property_name, propertyIndexes in properties.iteritems():
+                if serial is not None:
+                    changedIndexes = []
+                    for index in propertyIndexes:
+                        if serials[index] == serial:
+                            results[index] = None
+                        else:
+                            changedIndexes.append(index)
+
+                    if not changedIndexes:
+                        continue
+
+                    propertyIndexes = changedIndexes
+
+                key = (component_path, property_name)
+                retryAfter = self._failures.retryAfter(key, now)
+                if not retryAfter:
+                    try:
+                        value = self.accessors.getValue(obj, property_name)
+                    except Exception, e:
+                        retryAfter = self._failed(
+                            component_path, property_name, e, now)
+                    else:
+                        self._failures.succeeded(key)
+
+                if retryAfter:
+                    for index in propertyIndexes:
+                        retries[index] = retryAfter
+                    continue
+
+                log.debug("%s -> %s = %s", component_path, property_name, value)
+                if serials is None:
+                    result = (value, time.time())
+                else:
+                    result = (value, time.time(), serial)
+                for index in propertyIndexes:
+                    results[index] = result
+
+        self._logFailures(now)
+        self._spendCacheBudget(len(indexes))
+
+        return results, retries
+
+    def _prefetch(self, component_paths):
+        """
+        Load the ghosts of already resolved components in one round trip,
+        on storages that support it, rather than one at a time as their
+        properties are read.
+        """
+        prefetch = getattr(self.dmd._p_jar, 'prefetch', None)
+        if prefetch is None:
+            return
+
+        oids = []
+        for component_path in component_paths:
+            obj = self._pathCache.peek(component_path)
+            if obj is not None:
+                base = aq_base(obj)
+                if base._p_changed is None:
+                    oids.append(base._p_oid)
+
+        if oids:
+            log.debug("Prefetching %d components", len(oids))
+            prefetch(oids)
+
+    def _spendCacheBudget(self, count):
+        """
+        Minimize the ZODB connection's object cache once count components
+        have been read since it was last minimized, so that components
+        that won't be read again for a whole interval don't keep hub
+        workers growing.
+        """
+        if self._cacheBudget <= 0:
+            return
+
+        self._cacheUsed += count
+        if self._cacheUsed >= self._cacheBudget:
+            log.debug("Read %d components, minimizing object cache",
+                      self._cacheUsed)
+            self.dmd._p_jar.cacheMinimize()
+            self._cacheUsed = 0
+
+    def _failed(self, component_path, property_name, e, now):
+        """
+        Record a failure to resolve component_path (property_name None) or
+        read one of its properties, and return how many seconds to hold
+        it off for.
+        """
+        groups = (component_path,)
+        device_path = self._devicePath(component_path)
+        if device_path != component_path:
+            groups += (device_path,)
+
+        retryAfter = self._failures.failed(
+            (component_path, property_name), now, groups)
+
+        log.debug("Unable to retrieve %s -> %s (%r), retrying in %ds",
+                  component_path, property_name, e, retryAfter)
+        self._failureLog[(component_path, property_name)] = e
+
+        return retryAfter
+
+    def _devicePath(self, component_path):
+        """
+        Return the path of the device component_path belongs to.  The
+        component may no longer exist, so this only looks at the path.
+        """
+        head, sep, tail = component_path.partition('/devices/')
+        if not sep:
+            return component_path
+
+        return head + sep + tail.split('/', 1)[0]
+
+    def _logFailures(self, now):
+        """
+        Log the failures recorded since the last time, if that was at
+        least failureLogInterval seconds ago.
+        """
+        if not self._failureLog or \
+           now - self._failureLogged < self.failureLogInterval:
+            return
+
+        examples = sorted(self._failureLog.iteritems())[:5]
+        log.error(
+            "Unable to retrieve %d properties in the last %ds (%d held off "
+            "in total), including: %s",
+            len(self._failureLog), now - self._failureLogged,
+            len(self._failures), '; '.join(
+                "%s -> %s (%r)" % (path, name or '*', e)
+                for (path, name), e in examples))
+
+        self._failureLog = {}
+        self._failureLogged = now
+
 
 class PropertyMonitorValueSpec(pb.Copyable, pb.RemoteCopy):
     def __init__(self, component_path, property_name, rrd, value):
@@ -129,11 +1068,18 @@ pb.setUnjellyableForClass(PropertyMonitorValueSpec, PropertyMonitorValueSpec)
 class PropertyMonitorDataSourceConfig(pb.Copyable, pb.RemoteCopy):
     """
     Represents a single PropertyMonitor datasource.
+
+    Called without arguments by unpackDataSourceConfigs, which sets the
+    attributes itself.
     """
 
-    def __init__(self, deviceOrComponent, template, datasource):
+    def __init__(self, deviceOrComponent=None, template=None, datasource=None,
+                 cycletimes=None):
+        if deviceOrComponent is None:
+            return
+
         self.device = deviceOrComponent.device().id
-        self.cycletime = datasource.getCycleTime(deviceOrComponent)
+        self.cycletime = datasource.getCycleTime(deviceOrComponent, cycletimes)
         self.datasourceId = datasource.id
         self.class_name = datasource.class_name
         self.component_path = deviceOrComponent.getPrimaryId()
@@ -143,6 +1089,41 @@ class PropertyMonitorDataSourceConfig(pb.Copyable, pb.RemoteCopy):
         for dp in datasource.datapoints():
             self.rrdConfig[dp.id] = RRDConfig(deviceOrComponent, datasource, dp)
 
+    def key(self):
+        """
+        Identifies this datasource within its device's config.
+        """
+        return (self.component_path, self.datasourceId)
+
+    def digest(self):
+        """
+        Changes whenever anything the collector uses changes.
+        """
+        state = [
+            self.device,
+            self.cycletime,
+            self.datasourceId,
+            self.class_name,
+            self.component_path,
+            self.property_name,
+            ]
+
+        for dpId in sorted(self.rrdConfig):
+            rrd = self.rrdConfig[dpId]
+            state.append((
+                dpId,
+                rrd.dpName,
+                rrd.command,
+                rrd.dataPointId,
+                rrd.min,
+                rrd.max,
+                rrd.rrdType,
+                rrd.rrdPath,
+                sorted(rrd.tags.iteritems()),
+                ))
+
+        return hashlib.md5(repr(state)).hexdigest()
+
 
 pb.setUnjellyableForClass(PropertyMonitorDataSourceConfig, PropertyMonitorDataSourceConfig)
 
@@ -152,9 +1133,15 @@ class RRDConfig(pb.Copyable, pb.RemoteCopy):
     RRD configuration for a datapoint.
     Contains the create command and the min and max 
     values for a datapoint
+
+    On collectors that write metrics with metadata, the metadata and
+    metric attributes are parsed from rrdPath when the config arrives.
     """
 
-    def __init__(self, deviceOrComponent, datasource, dp):
+    def __init__(self, deviceOrComponent=None, datasource=None, dp=None):
+        if deviceOrComponent is None:
+            return
+
         self.dpName = dp.name()
         self.command = dp.createCmd
         self.dataPointId = dp.id
@@ -169,3 +1156,111 @@ class RRDConfig(pb.Copyable, pb.RemoteCopy):
 
 
 pb.setUnjellyableForClass(RRDConfig, RRDConfig)
+
+
+class SymbolTable(object):
+    """
+    Assigns each distinct value a stable index into a list of symbols.
+    """
+
+    def __init__(self):
+        self.symbols = []
+        self._indexes = {}
+
+    def index(self, value):
+        if isinstance(value, dict):
+            key = (dict, repr(sorted(value.iteritems())))
+        else:
+            key = (type(value), repr(value))
+
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self.symbols)
+            self.symbols.append(value)
+
+        return index
+
+
+def packDataSourceConfigs(dsConfigs):
+    """
+    Pack dsConfigs for sending to the collector.
+
+    The strings, numbers and tag dicts in a device's datasource configs
+    are mostly shared by every component bound to the same template, so
+    each distinct value is sent once in a list of symbols, and the
+    configs are sent as a flat list of indexes into it.  Each rrdPath is
+    split into its component part and datapoint name so that both can be
+    shared.
+
+    Returns (symbols, packed).
+    """
+    table = SymbolTable()
+    index = table.index
+    packed = []
+    for dsConfig in dsConfigs:
+        packed.extend((
+            index(dsConfig.device),
+            index(dsConfig.cycletime),
+            index(dsConfig.datasourceId),
+            index(dsConfig.class_name),
+            index(dsConfig.component_path),
+            index(dsConfig.property_name),
+            len(dsConfig.rrdConfig),
+            ))
+
+        for dpId, rrd in dsConfig.rrdConfig.iteritems():
+            rrdPathPrefix, rrdPathName = rrd.rrdPath.rsplit('/', 1)
+            packed.extend((
+                index(dpId),
+                index(rrd.dpName),
+                index(rrd.command),
+                index(rrd.dataPointId),
+                index(rrd.min),
+                index(rrd.max),
+                index(rrd.rrdType),
+                index(rrdPathPrefix),
+                index(rrdPathName),
+                index(rrd.tags),
+                ))
+
+    return table.symbols, packed
+
+
+def unpackDataSourceConfigs(symbols, packed):
+    """
+    Rebuild the datasource configs packed by packDataSourceConfigs.
+
+    Strings are interned, so they are also shared with the configs of
+    other devices.
+    """
+    symbols = [intern(x) if type(x) is str else x for x in symbols]
+
+    dsConfigs = []
+    values = iter(packed)
+    for device in values:
+        dsConfig = PropertyMonitorDataSourceConfig()
+        dsConfig.device = symbols[device]
+        dsConfig.cycletime = symbols[next(values)]
+        dsConfig.datasourceId = symbols[next(values)]
+        dsConfig.class_name = symbols[next(values)]
+        dsConfig.component_path = symbols[next(values)]
+        dsConfig.property_name = symbols[next(values)]
+        dsConfig.rrdConfig = {}
+
+        for i in xrange(next(values)):
+            dpId = symbols[next(values)]
+            rrd = RRDConfig()
+            rrd.dpName = symbols[next(values)]
+            rrd.command = symbols[next(values)]
+            rrd.dataPointId = symbols[next(values)]
+            rrd.min = symbols[next(values)]
+            rrd.max = symbols[next(values)]
+            rrd.rrdType = symbols[next(values)]
+            rrd.rrdPath = '/'.join(
+                (symbols[next(values)], symbols[next(values)]))
+            rrd.tags = symbols[next(values)]
+            dsConfig.rrdConfig[dpId] = rrd
+
+        dsConfigs.append(dsConfig)
+
+    return dsConfigs
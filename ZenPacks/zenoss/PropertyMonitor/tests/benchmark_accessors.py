@@ -0,0 +1,89 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+Micro-benchmark of PropertyAccessors.getValue against reading the same
+property through IInfo, as zenhub did before.
+
+    python benchmark_accessors.py --device=<id> --class=<meta_type> \\
+        --property=<name> [--iterations=N]
+'''
+
+import time
+
+import Globals
+
+from Products.ZenUtils.Utils import unused
+from Products.ZenUtils.ZenScriptBase import ZenScriptBase
+from Products.Zuul.interfaces import IInfo
+
+from ZenPacks.zenoss.PropertyMonitor.utils import PropertyAccessors
+
+unused(Globals)
+
+
+class AccessorBenchmark(ZenScriptBase):
+
+    def buildOptions(self):
+        ZenScriptBase.buildOptions(self)
+        self.parser.add_option('--device', dest='device',
+                               help="Device whose components are read")
+        self.parser.add_option('--class', dest='class_name',
+                               help="meta_type of the components to read")
+        self.parser.add_option('--property', dest='property_name',
+                               help="Info property to read")
+        self.parser.add_option('--iterations', dest='iterations',
+                               type='int', default=100,
+                               help="Times to read every component (default=100)")
+
+    def run(self):
+        self.connect()
+
+        device = self.dmd.Devices.findDeviceByIdExact(self.options.device)
+        if device is None:
+            self.parser.error("device %s not found" % self.options.device)
+
+        components = [
+            x for x in device.getDeviceComponents()
+            if x.meta_type == self.options.class_name]
+        if self.options.class_name == device.meta_type:
+            components.append(device)
+
+        if not components:
+            self.parser.error("no %s components found" % self.options.class_name)
+
+        property_name = self.options.property_name
+        accessors = PropertyAccessors()
+
+        def viaInfo():
+            for component in components:
+                getattr(IInfo(component), property_name, None)
+
+        def viaAccessors():
+            for component in components:
+                accessors.getValue(component, property_name)
+
+        # Resolve the accessor, and load the components, before timing.
+        viaAccessors()
+
+        reads = len(components) * self.options.iterations
+        for name, fn in (('IInfo', viaInfo), ('PropertyAccessors', viaAccessors)):
+            start = time.time()
+            for i in xrange(self.options.iterations):
+                fn()
+            elapsed = time.time() - start
+            print "%-18s %8d reads %8.3fs %8.2fus/read" % (
+                name, reads, elapsed, elapsed / reads * 1e6)
+
+        for (meta_type, name), description in sorted(accessors.describe().items()):
+            print "%s.%s resolved to %s" % (meta_type, name, description)
+
+
+if __name__ == '__main__':
+    AccessorBenchmark().run()
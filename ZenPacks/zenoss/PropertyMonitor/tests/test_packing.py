@@ -0,0 +1,111 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+Unit tests for the packed datasource config format.
+'''
+
+import unittest
+
+from ZenPacks.zenoss.PropertyMonitor.services.PropertyMonitorService import (
+    PropertyMonitorDataSourceConfig,
+    RRDConfig,
+    SymbolTable,
+    packDataSourceConfigs,
+    unpackDataSourceConfigs,
+    )
+
+
+def makeConfig(component, datapoints=('a', 'b')):
+    dsConfig = PropertyMonitorDataSourceConfig()
+    dsConfig.device = 'dev1'
+    dsConfig.cycletime = 300
+    dsConfig.datasourceId = 'speed'
+    dsConfig.class_name = 'IpInterface'
+    dsConfig.component_path = '/zport/dmd/Devices/devices/dev1/os/interfaces/%s' % component
+    dsConfig.property_name = 'speed'
+    dsConfig.rrdConfig = {}
+    for dpId in datapoints:
+        rrd = RRDConfig()
+        rrd.dpName = 'speed_%s' % dpId
+        rrd.command = ''
+        rrd.dataPointId = dpId
+        rrd.min = None
+        rrd.max = 100.0
+        rrd.rrdType = 'GAUGE'
+        rrd.rrdPath = '{"METRIC_DATA": "%s"}/speed_%s' % (component, dpId)
+        rrd.tags = {'contextUUID': component, 'key': ['x']}
+        dsConfig.rrdConfig[dpId] = rrd
+
+    return dsConfig
+
+
+def state(dsConfig):
+    return (
+        dsConfig.device,
+        dsConfig.cycletime,
+        dsConfig.datasourceId,
+        dsConfig.class_name,
+        dsConfig.component_path,
+        dsConfig.property_name,
+        sorted(
+            (dpId, sorted(vars(rrd).items()))
+            for dpId, rrd in dsConfig.rrdConfig.items()),
+        )
+
+
+class TestSymbolTable(unittest.TestCase):
+
+    def test_index(self):
+        table = SymbolTable()
+        self.assertEqual(table.index('a'), 0)
+        self.assertEqual(table.index('b'), 1)
+        self.assertEqual(table.index('a'), 0)
+        self.assertEqual(table.symbols, ['a', 'b'])
+
+    def test_types_kept_apart(self):
+        table = SymbolTable()
+        indexes = set(table.index(x) for x in (1, 1.0, True, '1', None))
+        self.assertEqual(len(indexes), 5)
+
+    def test_equal_dicts_shared(self):
+        table = SymbolTable()
+        first = dict((str(i), i) for i in range(20))
+        second = dict((str(i), i) for i in reversed(range(20)))
+        self.assertEqual(table.index(first), table.index(second))
+        self.assertNotEqual(table.index(first), table.index({'0': 1}))
+
+
+class TestPacking(unittest.TestCase):
+
+    def test_round_trip(self):
+        dsConfigs = [makeConfig('eth0'), makeConfig('eth1', ('a',))]
+        symbols, packed = packDataSourceConfigs(dsConfigs)
+        unpacked = unpackDataSourceConfigs(symbols, packed)
+        self.assertEqual(
+            [state(x) for x in unpacked], [state(x) for x in dsConfigs])
+
+    def test_shared_values_sent_once(self):
+        symbols, packed = packDataSourceConfigs(
+            [makeConfig('eth%d' % i) for i in range(10)])
+        self.assertEqual(symbols.count('GAUGE'), 1)
+        self.assertEqual(symbols.count('speed_a'), 1)
+        self.assertTrue(all(isinstance(x, int) for x in packed))
+
+    def test_empty(self):
+        self.assertEqual(packDataSourceConfigs([]), ([], []))
+        self.assertEqual(unpackDataSourceConfigs([], []), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestSymbolTable))
+    suite.addTest(makeSuite(TestPacking))
+    return suite
@@ -0,0 +1,119 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+Unit tests for utils.
+'''
+
+import unittest
+
+from ZenPacks.zenoss.PropertyMonitor.utils import Backoff, LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get(self):
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_peek(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertEqual(cache.peek('c'), None)
+        cache.put('c', 3)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_evict_group(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, ('x',))
+        cache.put('b', 2, ('x', 'y'))
+        cache.put('c', 3, ('y',))
+        cache.evictGroup('x')
+        self.assertEqual(sorted(cache._entries), ['c'])
+        cache.evictGroup('y')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache._groups, {})
+
+    def test_put_replaces_groups(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, ('x',))
+        cache.put('a', 2, ('y',))
+        cache.evictGroup('x')
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_zero_size(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_doubles_up_to_maximum(self):
+        backoff = Backoff(10, initial=60, maximum=300)
+        self.assertEqual(backoff.retryAfter('a', 0), 0)
+        self.assertEqual(backoff.failed('a', 0), 60)
+        self.assertEqual(backoff.retryAfter('a', 20), 40)
+        self.assertEqual(backoff.retryAfter('a', 60), 0)
+        self.assertEqual(backoff.failed('a', 60), 120)
+        self.assertEqual(backoff.failed('a', 180), 240)
+        self.assertEqual(backoff.failed('a', 420), 300)
+        self.assertEqual(backoff.retryAfter('a', 420), 300)
+
+    def test_succeeded_resets(self):
+        backoff = Backoff(10, initial=60)
+        backoff.failed('a', 0)
+        backoff.failed('a', 60)
+        backoff.succeeded('a')
+        self.assertEqual(backoff.retryAfter('a', 60), 0)
+        self.assertEqual(backoff.failed('a', 60), 60)
+
+    def test_evict_group(self):
+        backoff = Backoff(10)
+        backoff.failed(('/a/c1', 'p'), 0, ('/a/c1', '/a'))
+        backoff.failed(('/b/c2', 'p'), 0, ('/b/c2', '/b'))
+        backoff.evictGroup('/a')
+        self.assertEqual(backoff.retryAfter(('/a/c1', 'p'), 0), 0)
+        self.assertNotEqual(backoff.retryAfter(('/b/c2', 'p'), 0), 0)
+        self.assertEqual(len(backoff), 1)
+
+    def test_bounded(self):
+        backoff = Backoff(2)
+        for key in 'abc':
+            backoff.failed(key, 0)
+        self.assertEqual(len(backoff), 2)
+        self.assertEqual(backoff.retryAfter('a', 0), 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestLRUCache))
+    suite.addTest(makeSuite(TestBackoff))
+    return suite
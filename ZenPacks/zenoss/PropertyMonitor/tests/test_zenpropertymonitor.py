@@ -0,0 +1,208 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+Unit tests for zenpropertymonitor.
+'''
+
+import unittest
+
+from twisted.internet import error
+from twisted.spread import jelly, pb
+
+from ZenPacks.zenoss.PropertyMonitor.zenpropertymonitor import (
+    IntervalWorker,
+    TaskSplitter,
+    streaming_unsupported,
+    )
+
+
+class Options(object):
+    querytarget = 5.0
+
+
+class Preferences(object):
+    options = Options()
+
+
+class Collector(object):
+    preferences = Preferences()
+
+
+class RRD(object):
+    def __init__(self, rrdPath):
+        self.rrdPath = rrdPath
+
+
+def makeWorker(chunkSize=256, minChunkSize=32, maxChunkSize=4096):
+    # Skip __init__, which needs a running collector.
+    worker = IntervalWorker.__new__(IntervalWorker)
+    worker.name = 'IntervalWorker-300'
+    worker.specs = {}
+    worker.specIds = {}
+    worker.ownedIds = {}
+    worker.propertyIds = {}
+    worker._nextSpecId = 0
+    worker._unregisteredIds = set()
+    worker._removedIds = set()
+    worker.slots = 1
+    worker.pendingSlots = [set()]
+    worker._collector = Collector()
+    worker.chunkSize = chunkSize
+    worker.minChunkSize = minChunkSize
+    worker.maxChunkSize = maxChunkSize
+    worker._queryStats = [0, 0, 0.0, 0]
+    worker.statistics = {}
+    worker.setStatistic = worker.statistics.__setitem__
+    return worker
+
+
+def makeTaskSplitter():
+    # Skip __init__, and never talk to zenhub.
+    splitter = TaskSplitter.__new__(TaskSplitter)
+    splitter._configs = {}
+    splitter._pendingAcks = {}
+    splitter._pendingFullConfigs = set()
+    splitter.scheduleFlush = lambda: None
+    return splitter
+
+
+class DSConfig(object):
+    def __init__(self, name):
+        self.name = name
+
+    def key(self):
+        return self.name
+
+
+class DeviceConfig(object):
+    def __init__(self, dsConfigs, version, base=None, removed=()):
+        self.id = 'dev1'
+        self.dsConfigs = [DSConfig(x) for x in dsConfigs]
+        self.dsConfigVersion = version
+        self.dsConfigBase = base
+        self.dsConfigsRemoved = list(removed)
+
+
+class TestAdaptChunkSize(unittest.TestCase):
+
+    def adapt(self, worker, queries, specs, seconds):
+        worker._queryStats = [queries, specs, seconds, specs]
+        worker.adaptChunkSize()
+        return worker.chunkSize
+
+    def test_no_queries(self):
+        worker = makeWorker()
+        worker.adaptChunkSize()
+        self.assertEqual(worker.chunkSize, 256)
+        self.assertEqual(worker.statistics, {})
+
+    def test_on_target(self):
+        worker = makeWorker()
+        self.assertEqual(self.adapt(worker, 4, 1024, 20.0), 256)
+        self.assertEqual(worker.statistics, {'QueryChunkSize': 256})
+
+    def test_grows_at_most_double(self):
+        worker = makeWorker()
+        self.assertEqual(self.adapt(worker, 1, 256, 0.256), 512)
+        self.assertEqual(self.adapt(worker, 1, 512, 0.512), 1024)
+
+    def test_shrinks_at_most_half(self):
+        worker = makeWorker()
+        self.assertEqual(self.adapt(worker, 1, 256, 25.6), 128)
+
+    def test_towards_target(self):
+        worker = makeWorker()
+        # 25ms per spec -> 200 specs in 5 seconds.
+        self.assertEqual(self.adapt(worker, 1, 256, 6.4), 200)
+
+    def test_bounds(self):
+        worker = makeWorker(chunkSize=48, minChunkSize=32, maxChunkSize=64)
+        self.assertEqual(self.adapt(worker, 1, 48, 100.0), 32)
+        self.assertEqual(self.adapt(worker, 1, 32, 0.0), 64)
+
+
+class TestSpecs(unittest.TestCase):
+
+    def test_redelivered_spec_is_no_longer_held_off(self):
+        worker = makeWorker()
+        specs = [('/dev1/os/interfaces/eth0', 'speed', RRD('eth0/speed'))]
+        worker.replaceSpecs('dev1', specs)
+        (specId,) = worker.specs
+        worker.holdOff([specId, 3600])
+        worker.markAllDue()
+        self.assertEqual(worker.queueSize(), 0)
+
+        worker.replaceSpecs('dev1', specs)
+        self.assertEqual(worker.specs.keys(), [specId])
+        self.assertEqual(worker.specs[specId].retryAt, 0)
+        worker.markAllDue()
+        self.assertEqual(worker.queueSize(), 1)
+
+
+class TestApplyDelta(unittest.TestCase):
+
+    def names(self, config):
+        return sorted(x.name for x in config.dsConfigs)
+
+    def test_full_config(self):
+        splitter = makeTaskSplitter()
+        config = DeviceConfig(['a', 'b'], 'v1')
+        self.assertTrue(splitter.applyDelta(config))
+        self.assertEqual(self.names(config), ['a', 'b'])
+        self.assertEqual(splitter._pendingAcks, {'dev1': 'v1'})
+
+    def test_delta_config(self):
+        splitter = makeTaskSplitter()
+        splitter.applyDelta(DeviceConfig(['a', 'b'], 'v1'))
+        config = DeviceConfig(['c'], 'v2', base='v1', removed=['a'])
+        self.assertTrue(splitter.applyDelta(config))
+        self.assertEqual(self.names(config), ['b', 'c'])
+        self.assertEqual(splitter._pendingAcks, {'dev1': 'v2'})
+
+    def test_delta_against_other_version(self):
+        splitter = makeTaskSplitter()
+        splitter.applyDelta(DeviceConfig(['a', 'b'], 'v1'))
+        config = DeviceConfig(['c'], 'v3', base='v2')
+        self.assertTrue(splitter.applyDelta(config))
+        self.assertEqual(self.names(config), ['a', 'b'])
+        self.assertEqual(splitter._pendingFullConfigs, set(['dev1']))
+
+    def test_delta_without_applied_config(self):
+        splitter = makeTaskSplitter()
+        config = DeviceConfig(['c'], 'v2', base='v1')
+        self.assertFalse(splitter.applyDelta(config))
+        self.assertEqual(splitter._pendingFullConfigs, set(['dev1']))
+        self.assertEqual(splitter._pendingAcks, {'dev1': None})
+
+
+class TestStreamingUnsupported(unittest.TestCase):
+
+    def test_unsupported(self):
+        self.assertTrue(streaming_unsupported(jelly.InsecureJelly('x')))
+        self.assertTrue(streaming_unsupported(
+            pb.RemoteError('cPickle.PicklingError', 'x', None)))
+        self.assertTrue(streaming_unsupported(
+            pb.RemoteError('twisted.spread.flavors.NoSuchMethod', 'x', None)))
+
+    def test_transient(self):
+        self.assertFalse(streaming_unsupported(error.TimeoutError()))
+        self.assertFalse(streaming_unsupported(pb.PBConnectionLost()))
+        self.assertFalse(streaming_unsupported(
+            pb.RemoteError('exceptions.KeyError', 'x', None)))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestAdaptChunkSize))
+    suite.addTest(makeSuite(TestSpecs))
+    suite.addTest(makeSuite(TestApplyDelta))
+    suite.addTest(makeSuite(TestStreamingUnsupported))
+    return suite
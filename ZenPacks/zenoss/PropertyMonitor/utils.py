@@ -7,9 +7,13 @@
 #
 ##############################################################################
 
+import collections
 import logging
 LOG = logging.getLogger('ZenPacks.zenoss.PropertyMonitor.utils')
 
+from Products.Zuul.infos import ProxyProperty
+from Products.Zuul.interfaces import IInfo
+
 
 def add_local_lib_path():
     '''
@@ -31,3 +35,259 @@ def get_all_subclasses(class_):
         subclasses.extend(get_all_subclasses(subclass))
 
     return subclasses
+
+
+class LRUCache(object):
+    '''
+    Bounded least-recently-used mapping with hit and miss counters.
+
+    Entries may be tagged with any number of groups so that related
+    entries can be evicted together with evictGroup.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value, groups = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries[key] = (value, groups)
+        return value
+
+    def peek(self, key, default=None):
+        '''
+        As get, but without counting or refreshing the entry.
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        return entry[0]
+
+    def put(self, key, value, groups=()):
+        self.pop(key)
+        if self.maxsize <= 0:
+            return
+
+        while len(self._entries) >= self.maxsize:
+            self.pop(next(iter(self._entries)))
+
+        self._entries[key] = (value, groups)
+        for group in groups:
+            self._groups.setdefault(group, set()).add(key)
+
+    def pop(self, key, default=None):
+        try:
+            value, groups = self._entries.pop(key)
+        except KeyError:
+            return default
+
+        for group in groups:
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
+
+        return value
+
+    def evictGroup(self, group):
+        '''
+        Evict all entries tagged with group.
+        '''
+        for key in list(self._groups.get(group, ())):
+            self.pop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._groups.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            }
+
+
+class Backoff(object):
+    '''
+    Exponential backoff for keys that keep failing.
+
+    A key's first failure holds it off for initial seconds, and each
+    consecutive failure doubles that, up to maximum seconds.  At most
+    maxsize keys are remembered, and they may be grouped and evicted
+    together as in LRUCache.
+    '''
+
+    def __init__(self, maxsize, initial=60, maximum=60 * 60):
+        self.initial = initial
+        self.maximum = maximum
+        self._failures = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self._failures)
+
+    def retryAfter(self, key, now):
+        '''
+        Return the number of seconds key is held off for, or 0.
+        '''
+        if key not in self._failures:
+            return 0
+
+        return max(0, self._failures.get(key)[1] - now)
+
+    def failed(self, key, now, groups=()):
+        '''
+        Record a failure of key, and return the number of seconds it is
+        now held off for.
+        '''
+        failures = self._failures.get(key, (0, None))[0] + 1
+        delay = min(self.maximum, self.initial * 2 ** (failures - 1))
+        self._failures.put(key, (failures, now + delay), groups)
+        return delay
+
+    def succeeded(self, key):
+        self._failures.pop(key)
+
+    def evictGroup(self, group):
+        self._failures.evictGroup(group)
+
+
+class PropertyAccessors(object):
+    '''
+    Table of property readers, resolved once per (meta_type, property_name).
+
+    Reading a property through IInfo costs an adapter lookup and a new
+    Info object for every value.  When the Info property is a plain
+    ProxyProperty the reader gets the underlying attribute straight from
+    the object instead, and only computed Info properties go through IInfo.
+    '''
+
+    def __init__(self):
+        self.accessors = {}
+
+    def getValue(self, obj, property_name, default=None):
+        key = (obj.meta_type, property_name)
+        accessor = self.accessors.get(key)
+        if accessor is None:
+            accessor = self.accessors[key] = self._resolve(obj, property_name)
+            LOG.debug("%s.%s resolved to %s", key[0], key[1], accessor.description)
+
+        return accessor(obj, default)
+
+    def describe(self):
+        '''
+        Return {(meta_type, property_name): description} for introspection.
+        '''
+        return dict(
+            (key, accessor.description)
+            for key, accessor in self.accessors.iteritems())
+
+    def _resolve(self, obj, property_name):
+        descriptor = None
+        for klass in type(IInfo(obj)).__mro__:
+            if property_name in klass.__dict__:
+                descriptor = klass.__dict__[property_name]
+                break
+
+        # Subclasses of ProxyProperty may do more than getattr.
+        if type(descriptor) is ProxyProperty:
+            attribute_name = descriptor.propertyName
+
+            def accessor(obj, default):
+                return getattr(obj, attribute_name, default)
+
+            accessor.description = 'attribute %s' % attribute_name
+        else:
+            def accessor(obj, default):
+                return getattr(IInfo(obj), property_name, default)
+
+            accessor.description = 'IInfo'
+
+        return accessor
+
+
+class TemplateResolver(object):
+    '''
+    Memoizes component template bindings during a config build.
+
+    Components of the same meta_type, asking for the same template names
+    under the same device class, are bound to the same templates, so
+    getRRDTemplates (and zenpacklib's -replacement and -addition lookups)
+    only needs to run once for all of them.  Components with their own
+    local templates are always resolved individually, and devices with
+    local templates get bindings of their own.
+    '''
+
+    def __init__(self):
+        self.templates = {}
+        self.datasources = {}
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def getDataSourcesByClass(self, template, sourcetype):
+        '''
+        Return {class_name: [datasource]} for template's enabled datasources
+        of sourcetype.
+        '''
+        key = (template.getPrimaryId(), sourcetype)
+        index = self.datasources.get(key)
+        if index is None:
+            index = self.datasources[key] = {}
+            for datasource in template.getRRDDataSources(sourcetype):
+                if datasource.enabled:
+                    index.setdefault(datasource.class_name, []).append(datasource)
+
+        return index
+
+    def getRRDTemplates(self, component, device):
+        key = self._key(component, device)
+        if key is None:
+            return component.getRRDTemplates()
+
+        templates = self.templates.get(key)
+        if templates is None:
+            self.misses += 1
+            templates = self.templates[key] = component.getRRDTemplates()
+        else:
+            self.hits += 1
+
+        return templates
+
+    def _key(self, component, device):
+        if component.objectIds('RRDTemplate'):
+            return None
+
+        # zenpacklib components bind every template in _templates.
+        names = getattr(component, '_templates', None)
+        if names is None:
+            names = (component.getRRDTemplateName(),)
+
+        if device.objectIds('RRDTemplate'):
+            override = device.id
+        else:
+            override = None
+
+        return (
+            device.getDeviceClassPath(),
+            component.meta_type,
+            tuple(names),
+            override)
@@ -19,17 +19,23 @@ import Globals
 import zope.component
 import zope.interface
 import json
+import time
+import uuid
+import zlib
 
-from twisted.internet import defer, task
-from twisted.spread import pb
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+from twisted.spread import jelly, pb
 
 from Products.ZenCollector.daemon import CollectorDaemon
 
 from Products.ZenCollector.interfaces import (
     ICollector,
     ICollectorPreferences,
+    IConfigurationListener,
     IScheduledTask,
     IDataService,
+    IStatisticsService,
 )
 
 from Products.ZenCollector.tasks import (
@@ -42,7 +48,7 @@ from Products.ZenCollector.tasks import (
 
 from ZenPacks.zenoss.PropertyMonitor.services.PropertyMonitorService import (
     PropertyMonitorDataSourceConfig,
-    PropertyMonitorValueSpec,
+    unpackDataSourceConfigs,
 )
 
 
@@ -71,7 +77,75 @@ class PropertyMonitorCollectorDaemon(CollectorDaemon):
 
         self.parser.add_option('--querychunksize',
                                dest="querychunksize", type="int", default=256,
-                               help="Number of properties to include in each zenhub query (default=256)")
+                               help="Number of properties to include in each zenhub query "
+                                    "at first (default=256).  The number is then adjusted "
+                                    "each cycle towards --querytarget")
+        self.parser.add_option('--minquerychunksize',
+                               dest="minquerychunksize", type="int", default=32,
+                               help="Fewest properties to include in each zenhub query "
+                                    "(default=32)")
+        self.parser.add_option('--maxquerychunksize',
+                               dest="maxquerychunksize", type="int", default=4096,
+                               help="Most properties to include in each zenhub query "
+                                    "(default=4096)")
+        self.parser.add_option('--querytarget',
+                               dest="querytarget", type="float", default=5.0,
+                               help="Number of seconds each zenhub query should take "
+                                    "(default=5.0)")
+        self.parser.add_option('--registerchunksize',
+                               dest="registerchunksize", type="int", default=4096,
+                               help="Number of property definitions to include in each "
+                                    "zenhub registration call (default=4096)")
+        self.parser.add_option('--maxinflightchunks',
+                               dest="maxinflightchunks", type="int", default=4,
+                               help="Number of zenhub queries each interval may have "
+                                    "outstanding at once (default=4)")
+        self.parser.add_option('--aggregatetasks',
+                               dest="aggregatetasks", action="store_true", default=False,
+                               help="Schedule one task per polling interval instead of "
+                                    "one per device and polling interval")
+        self.parser.add_option('--intervalslots',
+                               dest="intervalslots", type="int", default=1,
+                               help="Number of slots to spread each polling interval's "
+                                    "zenhub queries over (default=1)")
+        self.parser.add_option('--deltaconfigs',
+                               dest="deltaconfigs", action="store_true", default=False,
+                               help="Have zenhub send only the datasources that changed "
+                                    "since the last device config this daemon applied")
+        self.parser.add_option('--changedonly',
+                               dest="changedonly", action="store_true", default=False,
+                               help="Only have zenhub read properties of components that "
+                                    "changed since their last fetch, and write the last "
+                                    "value again for the others")
+        self.parser.add_option('--pushvalues',
+                               dest="pushvalues", action="store_true", default=False,
+                               help="Have zenhub push the values of properties it sees "
+                                    "change, and write the last value again each cycle "
+                                    "instead of fetching it.  Only devices whose configs "
+                                    "the main zenhub process built are pushed; with "
+                                    "zenhub workers, others refresh after --pushrefresh")
+        self.parser.add_option('--pushrefresh',
+                               dest="pushrefresh", type="int", default=60 * 60,
+                               help="With --pushvalues, still fetch values from zenhub "
+                                    "when they are older than this many seconds "
+                                    "(default=3600)")
+        self.parser.add_option('--streamvalues',
+                               dest="streamvalues", action="store_true", default=False,
+                               help="Have zenhub send each query's values in batches as "
+                                    "they are read, and write each batch as it arrives. "
+                                    "Ignored with --changedonly")
+        self.parser.add_option('--streambatchsize',
+                               dest="streambatchsize", type="int", default=32,
+                               help="Number of values in each batch zenhub streams "
+                                    "(default=32)")
+
+    def remote_pushPropertyValues(self, values):
+        """
+        Receive values zenhub saw change, as a flat list of (component
+        path, property name, value, timestamp) quadruples.
+        """
+        for worker in IntervalWorker.workers.values():
+            worker.updateValues(values)
 
     def getDevicePingIssues(result):
         # we don't care about device connectivity issues, since all
@@ -79,13 +153,283 @@ class PropertyMonitorCollectorDaemon(CollectorDaemon):
         return defer.succeed([])
 
 
+def extract_metadata(path):
+    """
+    Extracts metadata from datapoint's RRD Path.
+    """
+    metricinfo, metric = path.rsplit("/", 1)
+    if "METRIC_DATA" not in metricinfo:
+        raise Exception(
+            "Unable to write Metric with given path { %s } "
+            "please see the rrdpath method" % (metricinfo,)
+        )
+
+    metadata = json.loads(metricinfo)
+    return metadata, metric
+
+
+def streaming_unsupported(error):
+    """
+    Return True if error shows that zenhub can't stream values back to
+    this collector at all, rather than just failing this time.  Calls
+    routed to a zenhub worker fail this way, since the ValueReceiver
+    reference can't be pickled, as do zenhubs without the method.
+    """
+    if isinstance(error, (jelly.InsecureJelly, TypeError)):
+        return True
+
+    if isinstance(error, pb.RemoteError):
+        remoteType = str(error.remoteType)
+        return any(x in remoteType for x in (
+            'Jelly', 'Pickl', 'TypeError', 'NoSuchMethod'))
+
+    return False
+
+
 class TaskSplitter(SubConfigurationTaskSplitter):
     subconfigName = 'dsConfigs'
 
+    def __init__(self, taskFactory):
+        SubConfigurationTaskSplitter.__init__(self, taskFactory)
+        self._intervalTasks = set()
+
+        # Delta configs.  device id -> (dsConfigVersion, {key: dsConfig})
+        # for the configs applied so far, plus the acknowledgements and
+        # full config requests waiting to be sent to zenhub.
+        self.session = uuid.uuid4().hex
+        self._configs = {}
+        self._pendingAcks = {}
+        self._pendingFullConfigs = set()
+        self._flushCall = None
+
+    def splitConfiguration(self, configs):
+        for config in configs:
+            self.unpackConfig(config)
+
+        dataService = zope.component.queryUtility(IDataService)
+        if hasattr(dataService, 'writeMetricWithMetadata'):
+            for config in configs:
+                self.prepareMetadata(config)
+
+        collector = zope.component.queryUtility(ICollector)
+        if collector.preferences.options.deltaconfigs:
+            # Nothing can be built from a delta without the config it was
+            # made against, so leave such devices alone until their full
+            # config arrives.
+            configs = [x for x in configs if self.applyDelta(x)]
+
+        if not collector.preferences.options.aggregatetasks:
+            return SubConfigurationTaskSplitter.splitConfiguration(self, configs)
+
+        tasks = {}
+        for config in configs:
+            tasks.update(self.splitAggregated(config))
+
+        return tasks
+
+    def splitAggregated(self, config):
+        """
+        Hand config's datapoints straight to the IntervalWorker for each
+        polling interval, keyed by the device id, and only return an
+        IntervalTask the first time an interval is seen.  The number of
+        scheduled tasks then depends on the number of distinct intervals
+        rather than the number of devices.
+        """
+        specs = {}
+        for dsConfig in config.dsConfigs:
+            intervalSpecs = specs.setdefault(int(dsConfig.cycletime), [])
+            for rrdConfig in dsConfig.rrdConfig.values():
+                intervalSpecs.append(
+                    (dsConfig.component_path, dsConfig.property_name, rrdConfig))
+
+        for interval, worker in IntervalWorker.workers.items():
+            if interval not in specs:
+                worker.removeSpecs(config.id)
+
+        tasks = {}
+        for interval, intervalSpecs in specs.iteritems():
+            IntervalWorker.getWorker(interval).replaceSpecs(config.id, intervalSpecs)
+
+            taskName = "%s %d" % (IntervalTask.__name__, interval)
+            if taskName not in self._intervalTasks:
+                self._intervalTasks.add(taskName)
+                tasks[taskName] = IntervalTask(taskName, taskName, interval, None)
+
+        return tasks
+
+    def unpackConfig(self, config):
+        """
+        Rebuild config.dsConfigs if zenhub sent them packed.
+        """
+        packed = getattr(config, 'packedDsConfigs', None)
+        if packed is None:
+            return
+
+        config.dsConfigs = unpackDataSourceConfigs(config.dsConfigSymbols, packed)
+        del config.dsConfigSymbols
+        del config.packedDsConfigs
+
+    def applyDelta(self, config):
+        """
+        Rebuild config.dsConfigs from the previously applied config if
+        zenhub only sent the datasources that changed, and acknowledge the
+        resulting version so that zenhub can send deltas against it.
+        Return False if config is a delta that can't be applied, in which
+        case it mustn't be split.
+        """
+        version = getattr(config, 'dsConfigVersion', None)
+        base = getattr(config, 'dsConfigBase', None)
+        known = self._configs.get(config.id)
+
+        if base is None:
+            dsConfigs = dict((x.key(), x) for x in config.dsConfigs)
+        elif known is None or known[0] != base:
+            # Whatever zenhub thinks we applied, we don't have it.  Keep
+            # what we do have until the full config arrives.
+            log.info("%s: received delta config against unknown version %s, "
+                     "requesting full config" % (config.id, base))
+            self._pendingAcks[config.id] = None
+            self._pendingFullConfigs.add(config.id)
+            self.scheduleFlush()
+            if known is None:
+                return False
+
+            config.dsConfigs = known[1].values()
+            return True
+        else:
+            dsConfigs = dict(known[1])
+            for key in config.dsConfigsRemoved:
+                dsConfigs.pop(key, None)
+
+            for dsConfig in config.dsConfigs:
+                dsConfigs[dsConfig.key()] = dsConfig
+
+            log.debug("%s: applied delta config (%d changed, %d removed)" % (
+                config.id, len(config.dsConfigs), len(config.dsConfigsRemoved)))
+
+            config.dsConfigs = dsConfigs.values()
+
+        if version is None:
+            self._configs.pop(config.id, None)
+        else:
+            self._configs[config.id] = (version, dsConfigs)
+
+        # A full config means zenhub doesn't know what we applied, e.g.
+        # after resetConfigVersions or a zenhub restart, so always
+        # acknowledge it, even if we already had the same version.
+        if base is None or version != (known[0] if known else None):
+            self._pendingAcks[config.id] = version
+            self.scheduleFlush()
+
+        return True
+
+    def forgetConfig(self, configId):
+        """
+        Forget configId's applied config, and tell zenhub to do the same.
+        """
+        if self._configs.pop(configId, None) is not None:
+            self._pendingAcks[configId] = None
+            self.scheduleFlush()
+
+    def scheduleFlush(self):
+        if self._flushCall is None or not self._flushCall.active():
+            self._flushCall = reactor.callLater(0, self.flush)
+
+    @defer.inlineCallbacks
+    def flush(self):
+        """
+        Send pending acknowledgements and full config requests to zenhub
+        in one call each.
+        """
+        acks, self._pendingAcks = self._pendingAcks, {}
+        deviceIds, self._pendingFullConfigs = self._pendingFullConfigs, set()
+
+        collector = zope.component.queryUtility(ICollector)
+        remoteProxy = collector.getRemoteConfigServiceProxy()
+
+        try:
+            if acks:
+                yield remoteProxy.callRemote(
+                    'ackConfigVersions', self.session, acks)
+
+            if deviceIds:
+                configs = yield remoteProxy.callRemote(
+                    'getFullDeviceConfigs', list(deviceIds))
+                for config in configs:
+                    collector.remote_updateDeviceConfig(config)
+        except Exception:
+            # Without the acks zenhub keeps sending full configs, and
+            # devices missing a full config get it on the next config
+            # cycle.
+            log.exception("Unable to synchronize config versions with zenhub")
+
+    @defer.inlineCallbacks
+    def resetConfigVersions(self):
+        """
+        Tell zenhub this daemon hasn't applied any configs yet.  Used as
+        the daemon's initializationCallback.
+        """
+        collector = zope.component.queryUtility(ICollector)
+        if not collector.preferences.options.deltaconfigs:
+            return
+
+        remoteProxy = collector.getRemoteConfigServiceProxy()
+        try:
+            yield remoteProxy.callRemote('resetConfigVersions', self.session)
+        except Exception:
+            log.exception("Unable to reset config versions in zenhub")
+
+    def prepareMetadata(self, config):
+        """
+        Parse each datapoint's metric metadata once, when its config
+        arrives, rather than on every write.  Datapoints whose rrdPath
+        doesn't carry metadata are dropped.
+        """
+        for dsConfig in config.dsConfigs:
+            for dpId, rrdConfig in dsConfig.rrdConfig.items():
+                try:
+                    rrdConfig.metadata, rrdConfig.metric = extract_metadata(
+                        rrdConfig.rrdPath)
+                except Exception as e:
+                    log.error("Ignoring datapoint %s on %s: %s" % (
+                        rrdConfig.dpName, dsConfig.component_path, e))
+                    del dsConfig.rrdConfig[dpId]
+
     def makeConfigKey(self, config, subconfig):
         return (config.id, str(subconfig.cycletime))
 
 
+class SpecEntry(object):
+    """
+    A datapoint collected by an IntervalWorker.
+    """
+
+    __slots__ = (
+        'component_path', 'property_name', 'rrd', 'owner', 'slot', 'value',
+        'timestamp', 'retryAt', 'serial', 'fetched')
+
+    def __init__(self, component_path, property_name, rrd):
+        self.component_path = component_path
+        self.property_name = property_name
+        self.rrd = rrd
+        self.owner = None
+        self.slot = 0
+        self.value = None
+        self.timestamp = None
+        self.retryAt = 0
+        self.serial = None
+        self.fetched = None
+
+    def __str__(self):
+        return "SpecEntry(%s:%s rrdPath=%s, value=%s, timestamp=%s)" % (
+            self.component_path,
+            self.property_name,
+            self.rrd.rrdPath,
+            self.value,
+            self.timestamp
+        )
+
+
 class IntervalWorker(object):
     workers = {}
 
@@ -95,7 +439,41 @@ class IntervalWorker(object):
         self._dataService = zope.component.queryUtility(IDataService)
         self._collector = zope.component.queryUtility(ICollector)
 
-        self.pendingSpecs = set()
+        # Spec table shared with zenhub.  Each spec gets a compact integer
+        # id which is registered with PropertyMonitorService once, so that
+        # each cycle only the ids need to be sent to zenhub.  Ids are never
+        # reused within a session.
+        self.session = uuid.uuid4().hex
+        self.specs = {}
+        self.specIds = {}
+        self.ownedIds = {}
+        self.propertyIds = {}
+        self._nextSpecId = 0
+        self._unregisteredIds = set()
+        self._removedIds = set()
+
+        # Specs are spread over slots across the interval by a hash of their
+        # component path, which keeps each component's datapoints together.
+        # The LoopingCall runs once per slot and only dispatches that
+        # slot's share, so zenhub sees a steady request rate instead of one
+        # burst per interval.  Each spec is still collected once per
+        # interval.
+        self.slots = max(1, self._collector.preferences.options.intervalslots)
+        self.slotInterval = float(self.interval) / self.slots
+        self.pendingSlots = [set() for i in xrange(self.slots)]
+        self._nextSlot = 0
+        self._lastTick = None
+
+        # The number of specs in each query is adjusted after every cycle
+        # from the time zenhub took per spec.  [queries, specs, seconds,
+        # values] measured so far this cycle.
+        options = self._collector.preferences.options
+        self.minChunkSize = max(1, options.minquerychunksize)
+        self.maxChunkSize = max(self.minChunkSize, options.maxquerychunksize)
+        self.chunkSize = max(self.minChunkSize,
+                             min(self.maxChunkSize, options.querychunksize))
+        self._queryStats = [0, 0, 0.0, 0]
+
         self._loopingCall = task.LoopingCall(self)
         self._running = False
         self.writeMetricWithMetadata = hasattr(
@@ -103,6 +481,8 @@ class IntervalWorker(object):
         self.metricExtraTags = getattr(
             self._dataService, "metricExtraTags", False)
 
+        self.streamValues = options.streamvalues and not options.changedonly
+
     @classmethod
     def getWorker(cls, interval):
         if interval not in cls.workers:
@@ -125,70 +505,504 @@ class IntervalWorker(object):
         # Start (or re-start, if it stopped after an error) the loopingcall.
         try:
             log.info("IntervalWorker-%d LoopingCall starting" % self.interval)
-            yield self._loopingCall.start(self.interval)
+            yield self._loopingCall.start(self.slotInterval)
         except Exception:
             log.exception("IntervalWorker-%d LoopingCall encountered an error" % self.interval)
         finally:
             log.info("IntervalWorker-%d LoopingCall exited." % self.interval)
 
-    def addSpec(self, spec):
+    def addSpec(self, component_path, property_name, rrd, owner=None):
+        """
+        Add (or update) the spec for a datapoint, and return its id.
+
+        Specs live until their owner is removed with removeSpecs, and are
+        only collected in cycles they have been marked due with markDue.
+        """
+        specId = self.specIds.get(rrd.rrdPath)
+        if specId is not None:
+            spec = self.specs[specId]
+            if spec.component_path != component_path or \
+               spec.property_name != property_name:
+                # Same datapoint, different property.  zenhub may still
+                # have the old definition, so it needs a new id.
+                self._removeSpecId(specId)
+                specId = None
+
+        if specId is None:
+            specId = self._nextSpecId
+            self._nextSpecId += 1
+            spec = self.specs[specId] = SpecEntry(component_path, property_name, rrd)
+            spec.slot = zlib.crc32(component_path) % self.slots
+            self.specIds[rrd.rrdPath] = specId
+            self.propertyIds.setdefault(
+                (component_path, property_name), set()).add(specId)
+            self._unregisteredIds.add(specId)
+        else:
+            spec.rrd = rrd
+
+            # A config for the spec means the component exists again, e.g.
+            # it was deleted and re-created at the same path, and zenhub
+            # forgets its failures when it sees the component change.
+            spec.retryAt = 0
+
+        if spec.owner != owner and spec.owner in self.ownedIds:
+            # The replacement task for an updated device config may be
+            # created before the old task is cleaned up.
+            self.ownedIds[spec.owner].discard(specId)
+        spec.owner = owner
+        self.ownedIds.setdefault(owner, set()).add(specId)
+
         log.debug("[%s] addSpec: %s" % (self.name, spec))
-        self.pendingSpecs.add(spec)
+        return specId
+
+    def replaceSpecs(self, owner, specs):
+        """
+        Make specs, a list of (component_path, property_name, rrd) tuples,
+        the complete set of specs owned by owner.
+        """
+        previousIds = self.ownedIds.pop(owner, set())
+        for component_path, property_name, rrd in specs:
+            previousIds.discard(
+                self.addSpec(component_path, property_name, rrd, owner=owner))
+
+        for specId in previousIds:
+            if specId in self.specs and self.specs[specId].owner == owner:
+                self._removeSpecId(specId)
+
+    def markDue(self, owner):
+        """
+        Queue owner's specs to be collected the next time this worker runs.
+        Specs zenhub is holding off are skipped until it will retry them.
+        """
+        now = time.time()
+        for specId in self.ownedIds.get(owner, ()):
+            spec = self.specs[specId]
+            if spec.retryAt <= now:
+                self.pendingSlots[spec.slot].add(specId)
+
+    def markAllDue(self):
+        now = time.time()
+        for specId, spec in self.specs.iteritems():
+            if spec.retryAt <= now:
+                self.pendingSlots[spec.slot].add(specId)
+
+    def holdOff(self, failures):
+        """
+        Stop queueing specs zenhub couldn't read until it will try them
+        again.  failures is a flat list of (id, seconds) pairs.
+        """
+        now = time.time()
+        for i in xrange(0, len(failures), 2):
+            spec = self.specs.get(failures[i])
+            if spec is not None:
+                spec.retryAt = now + failures[i + 1]
+
+        if failures:
+            log.debug("%s: zenhub is holding off %d specs" % (
+                self.name, len(failures) / 2))
+
+    def removeSpecs(self, owner):
+        """
+        Forget all specs added by owner.
+        """
+        for specId in self.ownedIds.pop(owner, ()):
+            self._removeSpecId(specId)
+
+    def _removeSpecId(self, specId):
+        spec = self.specs.pop(specId)
+        del self.specIds[spec.rrd.rrdPath]
+        self.pendingSlots[spec.slot].discard(specId)
+
+        key = (spec.component_path, spec.property_name)
+        self.propertyIds[key].discard(specId)
+        if not self.propertyIds[key]:
+            del self.propertyIds[key]
+
+        if spec.owner in self.ownedIds:
+            self.ownedIds[spec.owner].discard(specId)
+
+        if specId in self._unregisteredIds:
+            self._unregisteredIds.discard(specId)
+        else:
+            self._removedIds.add(specId)
+
+    def updateValues(self, values):
+        """
+        Store values pushed by zenhub, a flat list of (component path,
+        property name, value, timestamp) quadruples, to be written in the
+        specs' next cycle.
+        """
+        for i in xrange(0, len(values), 4):
+            for specId in self.propertyIds.get((values[i], values[i + 1]), ()):
+                spec = self.specs[specId]
+                spec.value = values[i + 2]
+                spec.fetched = values[i + 3]
 
     def queueSize(self):
-        return len(self.pendingSpecs)
+        return sum(len(pendingIds) for pendingIds in self.pendingSlots)
+
+    def packSpecs(self, specIds):
+        """
+        Return the flattened (id, component_path, property_name) triples
+        for specIds, as expected by PropertyMonitorService.  Ids that have
+        been removed in the meantime are skipped.
+        """
+        packed = []
+        for specId in specIds:
+            spec = self.specs.get(specId)
+            if spec is None:
+                continue
+            packed.extend((specId, spec.component_path, spec.property_name))
+
+        return packed
+
+    @defer.inlineCallbacks
+    def registerSpecs(self, remoteProxy):
+        """
+        Send new and removed spec definitions to zenhub.
+        """
+        if not self._unregisteredIds and not self._removedIds:
+            return
+
+        unregisteredIds = list(self._unregisteredIds)
+        removedIds = list(self._removedIds)
+        self._unregisteredIds.clear()
+        self._removedIds.clear()
+
+        log.info("%s registering %d specs (%d removed)" % (
+            self.name, len(unregisteredIds), len(removedIds)))
+
+        chunksize = self._collector.preferences.options.registerchunksize
+        try:
+            for specIds_chunk in self.chunk(unregisteredIds, chunksize) or [[]]:
+                yield remoteProxy.callRemote(
+                    'register_specs', self.name, self.session,
+                    self.packSpecs(specIds_chunk),
+                    removedIds)
+                removedIds = []
+        except Exception:
+            # Not fatal, fetchValues will pass the definitions of any
+            # ids zenhub doesn't know about inline.
+            log.exception("%s unable to register specs" % self.name)
+
+    @defer.inlineCallbacks
+    def fetchValues(self, remoteProxy, specIds):
+        """
+        Fetch values for specIds from zenhub.
+
+        Returns a flat list of (id, value, timestamp) triples.
+        """
+        if self._collector.preferences.options.changedonly:
+            values = yield self.fetchChangedValues(remoteProxy, specIds)
+            defer.returnValue(values)
+
+        values, unknownIds, failures = yield remoteProxy.callRemote(
+            'fetch_spec_values', self.name, self.session, specIds)
+        self.holdOff(failures)
+
+        if unknownIds:
+            # This zenhub (or zenhub worker) hasn't seen these ids yet, so
+            # ask again with their definitions included.
+            log.debug("%s resending %d unknown specs" % (self.name, len(unknownIds)))
+            retried, unknownIds, failures = yield remoteProxy.callRemote(
+                'fetch_spec_values', self.name, self.session, unknownIds,
+                self.packSpecs(unknownIds))
+            values.extend(retried)
+            self.holdOff(failures)
+
+        defer.returnValue(values)
+
+    @defer.inlineCallbacks
+    def fetchChangedValues(self, remoteProxy, specIds, specs=()):
+        """
+        As fetchValues, but zenhub only reads the values of specs whose
+        component changed since their last fetch.  The last value of the
+        others is returned again with the current time, so their series
+        stay continuous.
+        """
+        serials = [self.specs[specId].serial if specId in self.specs else None
+                   for specId in specIds]
+        changed, unknownIds, failures, unchangedIds = yield remoteProxy.callRemote(
+            'fetch_changed_spec_values', self.name, self.session, specIds,
+            serials, specs)
+        self.holdOff(failures)
+
+        values = []
+        for i in xrange(0, len(changed), 4):
+            spec = self.specs.get(changed[i])
+            if spec is not None:
+                spec.serial = changed[i + 3]
+            values.extend(changed[i:i + 3])
+
+        now = time.time()
+        for specId in unchangedIds:
+            spec = self.specs.get(specId)
+            if spec is not None and spec.timestamp is not None:
+                values.extend((specId, spec.value, now))
+
+        if unknownIds and not specs:
+            log.debug("%s resending %d unknown specs" % (self.name, len(unknownIds)))
+            retried = yield self.fetchChangedValues(
+                remoteProxy, unknownIds, self.packSpecs(unknownIds))
+            values.extend(retried)
+
+        defer.returnValue(values)
 
     @defer.inlineCallbacks
     def __call__(self):
-        pendingSpecs = list(self.pendingSpecs)
-        self.pendingSpecs.clear()
+        # Dispatch this tick's slot, plus any slots skipped because the
+        # previous tick ran long.
+        now = time.time()
+        slots = 1
+        if self._lastTick is not None:
+            slots = int(round((now - self._lastTick) / self.slotInterval))
+            slots = min(max(1, slots), self.slots)
+        self._lastTick = now
 
-        if not pendingSpecs:
+        pendingIds = []
+        for i in xrange(slots):
+            slot = self._nextSlot
+            self._nextSlot = (slot + 1) % self.slots
+            self.setStatistic('Slot%dQueueDepth' % slot, len(self.pendingSlots[slot]))
+            pendingIds.extend(self.pendingSlots[slot])
+            self.pendingSlots[slot].clear()
+
+        # Ids are allocated in the order tasks add them, so sorting keeps
+        # the datapoints of each component together in the same chunk,
+        # where zenhub only needs to resolve the component once.
+        pendingIds.sort()
+
+        if not pendingIds:
             log.info("%s - no pending queries" % (self.name))
             return
 
-        log.info("%s processing %d pending queries" % (self.name, len(pendingSpecs)))
+        options = self._collector.preferences.options
+        if options.pushvalues:
+            # zenhub pushes changed values, so the last value is still
+            # current unless it's too old to trust.
+            cached = []
+            fetchIds = []
+            for specId in pendingIds:
+                spec = self.specs[specId]
+                if spec.fetched is not None and now - spec.fetched < options.pushrefresh:
+                    cached.extend((specId, spec.value, now))
+                else:
+                    fetchIds.append(specId)
+
+            if cached:
+                yield self.writeValues(cached, fetched=False)
+
+            pendingIds = fetchIds
+            if not pendingIds:
+                return
+
+        log.info("%s processing %d pending queries" % (self.name, len(pendingIds)))
 
         remoteProxy = self._collector.getRemoteConfigServiceProxy()
-        chunksize = self._collector.preferences.options.querychunksize
+        chunksize = self.chunkSize
+        self._queryStats = [0, 0, 0.0, 0]
 
-        for specs_chunk in self.chunk(pendingSpecs, chunksize):
-            processedSpecs = yield remoteProxy.callRemote('fetch_values', specs_chunk)
+        yield self.registerSpecs(remoteProxy)
 
-            for spec in processedSpecs:
-                tags = getattr(spec.rrd, "tags", None)
-                if tags and self.metricExtraTags:
-                    write_kwargs = {"extraTags": tags}
-                else:
-                    write_kwargs = {}
-                log.debug("[%s] processSpec: %s" % (self.name, spec))
-                try:
-                    if self.writeMetricWithMetadata:
-                        metadata, metric = self.extract_metadata(spec.rrd.rrdPath)
-                        yield defer.maybeDeferred(
-                            self._dataService.writeMetricWithMetadata,
-                            metric,
-                            spec.value,
-                            spec.rrd.rrdType,
-                            timestamp=spec.timestamp,
-                            min=spec.rrd.min,
-                            max=spec.rrd.max,
-                            metadata=metadata,
-                            **write_kwargs)
-                    else:
-                        yield defer.maybeDeferred(
-                            self._dataService.writeRRD,
-                            spec.rrd.rrdPath,
-                            spec.value,
-                            spec.rrd.rrdType,
-                            rrdCommand=spec.rrd.command,
-                            cycleTime=self.interval,
-                            min=spec.rrd.min,
-                            max=spec.rrd.max)
+        # Keep up to maxinflightchunks fetches outstanding at once.  A
+        # chunk gives up its slot as soon as its values arrive, so writing
+        # them overlaps the fetches still in flight.
+        window = defer.DeferredSemaphore(max(1, options.maxinflightchunks))
+        yield defer.DeferredList([
+            self.processChunk(remoteProxy, specIds_chunk, window)
+            for specIds_chunk in self.chunk(pendingIds, chunksize)])
 
-                except Exception as e:
-                    log.exception("An exception occurred during write metric call for datapoint - {}. "
-                                  "Exception message: {}".format(spec.rrd.dpName, e))
+        self.adaptChunkSize()
+
+    def adaptChunkSize(self):
+        """
+        Set the number of specs in the next cycle's queries so that each
+        query takes about --querytarget seconds, at the time per spec
+        zenhub took this cycle.  The size at most halves or doubles from
+        one cycle to the next, within --minquerychunksize and
+        --maxquerychunksize.
+        """
+        queries, specs, seconds, values = self._queryStats
+        if not specs:
+            return
+
+        perSpec = seconds / specs
+        if perSpec > 0:
+            target = self._collector.preferences.options.querytarget / perSpec
+        else:
+            target = self.maxChunkSize
+
+        chunkSize = int(max(self.chunkSize / 2, min(self.chunkSize * 2, target)))
+        chunkSize = max(self.minChunkSize, min(self.maxChunkSize, chunkSize))
+
+        log.log(
+            logging.INFO if chunkSize != self.chunkSize else logging.DEBUG,
+            "%s query chunk size %d -> %d (%d queries, %.2fms and %.2f values "
+            "per spec)" % (
+                self.name, self.chunkSize, chunkSize, queries,
+                perSpec * 1000, float(values) / specs))
+
+        self.chunkSize = chunkSize
+        self.setStatistic('QueryChunkSize', chunkSize)
+
+    @defer.inlineCallbacks
+    def streamValuesFrom(self, remoteProxy, specIds):
+        """
+        Have zenhub stream the values of specIds to a ValueReceiver, which
+        writes each batch as it arrives.
+
+        Returns the ids that still need to be fetched: none, unless
+        streaming failed, in which case the ids that weren't received are
+        returned.  Streaming is also turned off for this worker if zenhub
+        can't do it at all.
+        """
+        receiver = ValueReceiver(self)
+        batchSize = self._collector.preferences.options.streambatchsize
+        try:
+            unknownIds = yield remoteProxy.callRemote(
+                'stream_spec_values', self.name, self.session, specIds,
+                receiver, (), batchSize)
+            if unknownIds:
+                log.debug("%s resending %d unknown specs" % (self.name, len(unknownIds)))
+                yield remoteProxy.callRemote(
+                    'stream_spec_values', self.name, self.session, unknownIds,
+                    receiver, self.packSpecs(unknownIds), batchSize)
+        except Exception as e:
+            if streaming_unsupported(e):
+                log.warning("%s unable to stream values from zenhub, fetching "
+                            "them instead: %s" % (self.name, e))
+                self.streamValues = False
+            else:
+                # e.g. a timeout, so try streaming again next time.
+                log.info("%s unable to stream values from zenhub, fetching "
+                         "them this time: %s" % (self.name, e))
+
+            defer.returnValue(
+                [specId for specId in specIds if specId not in receiver.received])
+
+        defer.returnValue([])
+
+    @defer.inlineCallbacks
+    def processChunk(self, remoteProxy, specIds, window):
+        yield window.acquire()
+        requested = len(specIds)
+        values = []
+        start = time.time()
+        try:
+            if self.streamValues:
+                specIds = yield self.streamValuesFrom(remoteProxy, specIds)
+                if not specIds:
+                    return
+
+            values = yield self.fetchValues(remoteProxy, specIds)
+        except Exception as e:
+            log.error("%s unable to fetch %d values from zenhub: %s" % (
+                self.name, len(specIds), e))
+            return
+        finally:
+            window.release()
+
+            # Failed queries count too, since they are usually timeouts.
+            stats = self._queryStats
+            stats[0] += 1
+            stats[1] += requested
+            stats[2] += time.time() - start
+            stats[3] += len(values) / 3
+
+        yield self.writeValues(values)
+
+    @defer.inlineCallbacks
+    def writeValues(self, values, fetched=True):
+        """
+        Write a flat list of (id, value, timestamp) triples as one batch.
+        fetched is False when the values are cached ones written again.
+
+        Every write is issued without waiting for the previous one, and the
+        batch waits for all of them at the end.
+        """
+        start = time.time()
+        specs = []
+        for i in xrange(0, len(values), 3):
+            spec = self.specs.get(values[i])
+            if spec is None:
+                # removed while the query was outstanding.
+                continue
+
+            spec.value = values[i + 1]
+            spec.timestamp = values[i + 2]
+            if fetched:
+                spec.fetched = spec.timestamp
+            log.debug("[%s] processSpec: %s" % (self.name, spec))
+            specs.append(spec)
+
+        writes = []
+        for spec in specs:
+            try:
+                d = self.writeSpec(spec)
+            except Exception as e:
+                self.writeFailed(e, spec)
+                continue
+
+            if isinstance(d, defer.Deferred):
+                writes.append(d.addErrback(self.writeFailed, spec))
+
+        if writes:
+            yield defer.DeferredList(writes)
+
+        latency = time.time() - start
+        log.debug("%s wrote %d values in %.3fs" % (self.name, len(specs), latency))
+        self.setStatistic('WriteLatency', latency)
+
+    def writeSpec(self, spec):
+        if self.writeMetricWithMetadata:
+            kwargs = dict(
+                metric=spec.rrd.metric,
+                value=spec.value,
+                metricType=spec.rrd.rrdType,
+                timestamp=spec.timestamp,
+                min=spec.rrd.min,
+                max=spec.rrd.max,
+                metadata=spec.rrd.metadata)
+
+            tags = getattr(spec.rrd, "tags", None)
+            if tags and self.metricExtraTags:
+                kwargs["extraTags"] = tags
+
+            return self._dataService.writeMetricWithMetadata(**kwargs)
+        else:
+            return self._dataService.writeRRD(
+                spec.rrd.rrdPath,
+                spec.value,
+                spec.rrd.rrdType,
+                rrdCommand=spec.rrd.command,
+                cycleTime=self.interval,
+                min=spec.rrd.min,
+                max=spec.rrd.max)
+
+    def writeFailed(self, e, spec):
+        if isinstance(e, failure.Failure):
+            e = e.value
+
+        log.error("An exception occurred during write metric call for datapoint - {}. "
+                  "Exception message: {}".format(spec.rrd.dpName, e))
+
+    def setStatistic(self, name, value):
+        """
+        Set this worker's gauge statistic name, reported with the daemon's
+        own statistics.
+        """
+        statService = zope.component.queryUtility(IStatisticsService)
+        if statService is None:
+            return
+
+        name = 'interval%d%s' % (self.interval, name)
+        try:
+            stat = statService.getStatistic(name)
+        except KeyError:
+            statService.addStatistic(name, 'GAUGE')
+            stat = statService.getStatistic(name)
+
+        stat.value = value
 
     def chunk(self, lst, n):
         """
@@ -196,19 +1010,28 @@ class IntervalWorker(object):
         """
         return [lst[i:i + n] for i in xrange(0, len(lst), n)]
 
-    def extract_metadata(self, path):
+
+class ValueReceiver(pb.Referenceable):
+    """
+    Receives the batches of values zenhub streams for an IntervalWorker.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.received = set()
+
+    def remote_values(self, values, failures):
         """
-        Extracts metadata from datapoint's RRD Path.
+        Write a batch of values, as returned by fetch_spec_values.  zenhub
+        waits for the write before sending more than one further batch.
         """
-        metricinfo, metric = path.rsplit("/", 1)
-        if "METRIC_DATA" not in str(metricinfo):
-            raise Exception(
-                "Unable to write Metric with given path { %s } "
-                "please see the rrdpath method" % (metricinfo,)
-            )
+        for i in xrange(0, len(values), 3):
+            self.received.add(values[i])
+        for i in xrange(0, len(failures), 2):
+            self.received.add(failures[i])
 
-        metadata = json.loads(metricinfo)
-        return metadata, metric
+        self.worker.holdOff(failures)
+        return self.worker.writeValues(values)
 
 
 class PropertyMonitorTask(BaseTask):
@@ -224,27 +1047,89 @@ class PropertyMonitorTask(BaseTask):
         self.interval = int(scheduleIntervalSeconds)
         self.config = taskConfig
 
+        self.registerSpecs()
+
     def getWorker(self):
         return IntervalWorker.getWorker(self.interval)
 
-    def doTask(self):
+    def registerSpecs(self):
+        """
+        Add this task's datapoints to its IntervalWorker.  This happens
+        once, when the config arrives; each run then just marks them due.
+        """
         worker = self.getWorker()
         for dsConfig in self.config.dsConfigs:
             for rrdConfig in dsConfig.rrdConfig.values():
-                valueSpec = PropertyMonitorValueSpec(dsConfig.component_path, dsConfig.property_name, rrdConfig, None)
+                worker.addSpec(dsConfig.component_path, dsConfig.property_name, rrdConfig, owner=self)
+
+    def doTask(self):
+        worker = self.getWorker()
+
+        # Queue this task's values up to be collected the next time the
+        # IntervalWorker for this polling interval runs.
+        worker.markDue(self)
+
+        log.debug("Worker %s: Queue size is now %d." % (worker.name, worker.queueSize()))
+
+    def cleanup(self):
+        self.getWorker().removeSpecs(self)
+
+
+class IntervalTask(BaseTask):
+    """
+    Marks every spec of an IntervalWorker due.  Used instead of per-device
+    PropertyMonitorTasks with --aggregatetasks.
+    """
+    zope.interface.implements(IScheduledTask)
+
+    def __init__(self, taskName, configId, scheduleIntervalSeconds, taskConfig):
+        super(IntervalTask, self).__init__(
+            taskName, configId, scheduleIntervalSeconds, taskConfig)
+
+        self.name = taskName
+        self.configId = configId
+        self.state = TaskStates.STATE_IDLE
+        self.interval = int(scheduleIntervalSeconds)
+        self.config = taskConfig
 
-                # Queue this value up to be collected the next time the
-                # IntervalWorker for this polling interval runs.
-                worker.addSpec(valueSpec)
+    def doTask(self):
+        worker = IntervalWorker.getWorker(self.interval)
+        worker.markAllDue()
 
         log.debug("Worker %s: Queue size is now %d." % (worker.name, worker.queueSize()))
 
 
+class ConfigListener(object):
+    """
+    Drops the specs of deleted devices that were handed straight to the
+    IntervalWorkers with --aggregatetasks, and their delta config state.
+    """
+    zope.interface.implements(IConfigurationListener)
+
+    def __init__(self, taskSplitter):
+        self.taskSplitter = taskSplitter
+
+    def deleted(self, configurationId):
+        for worker in IntervalWorker.workers.values():
+            worker.removeSpecs(configurationId)
+
+        self.taskSplitter.forgetConfig(configurationId)
+
+    def added(self, configuration):
+        pass
+
+    def updated(self, newConfiguration):
+        pass
+
+
 def main():
     preferences = Preferences()
     task_factory = SimpleTaskFactory(PropertyMonitorTask)
     task_splitter = TaskSplitter(task_factory)
-    daemon = PropertyMonitorCollectorDaemon(preferences, task_splitter)
+    daemon = PropertyMonitorCollectorDaemon(
+        preferences, task_splitter,
+        configurationListener=ConfigListener(task_splitter),
+        initializationCallback=task_splitter.resetConfigVersions)
     daemon.run()
 
 